@@ -0,0 +1,238 @@
+"""
+Benchmark suite of the client against the local mock server, which is started in a subprocess.
+Measures sequential and concurrent throughput, p50/p99 latency, memory allocated by the client per call and the CPU
+time spent signing requests and parsing responses. Results can be saved and compared with an earlier run; the comparison exits
+with status 1 when a figure got worse by more than the tolerance.
+Run from the repository root: python benchmarks/bench_client.py --save before.json
+                              python benchmarks/bench_client.py --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir))
+
+import iwan  # noqa: E402
+from mock_server import MockServer  # noqa: E402
+
+ADDRESS = "0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(port, items, latency):
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, "mock_server.py"), "--port", str(port),
+                               "--items", str(items), "--latency", str(latency)])
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("mock server did not start")
+
+
+def _percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _latency_figures(prefix, samples, elapsed):
+    return {prefix + "_calls_per_s": len(samples) / elapsed,
+            prefix + "_p50_ms": _percentile(samples, 0.5) * 1000,
+            prefix + "_p99_ms": _percentile(samples, 0.99) * 1000}
+
+
+def _sequential(uri, prefix, call, number):
+    api = iwan.ApiInstance("key", "secret", uri=uri)
+    try:
+        call(api)
+        samples = []
+        started = time.perf_counter()
+        for _ in range(number):
+            begin = time.perf_counter()
+            call(api)
+            samples.append(time.perf_counter() - begin)
+        return _latency_figures(prefix, samples, time.perf_counter() - started)
+    finally:
+        api.close()
+
+
+def _concurrent(uri, number, concurrency, pool_size):
+    async def run():
+        samples = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(api):
+            async with semaphore:
+                begin = time.perf_counter()
+                await api.get_balance(ADDRESS)
+                samples.append(time.perf_counter() - begin)
+
+        async with iwan.AsyncApiInstance("key", "secret", uri=uri, pool_size=pool_size) as api:
+            await api.get_balance(ADDRESS)
+            started = time.perf_counter()
+            await asyncio.gather(*(one(api) for _ in range(number)))
+            return _latency_figures("concurrent_balance", samples, time.perf_counter() - started)
+
+    return asyncio.run(run())
+
+
+def _peak(call, number):
+    # Measured on this thread without any I/O, so buffers of the event loop thread do not count.
+    call()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(number):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            call()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return _percentile(peaks, 0.5)
+
+
+def _retained(call, number):
+    # Memory still held by objects allocated in iwan.py after the calls, e.g. by a leak or an unbounded cache.
+    only_client = [tracemalloc.Filter(True, iwan.__file__)]
+    call()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(only_client)
+        for _ in range(number):
+            call()
+        after = tracemalloc.take_snapshot().filter_traces(only_client)
+    finally:
+        tracemalloc.stop()
+    return sum(stat.size_diff for stat in after.compare_to(before, 'filename')) / number
+
+
+def _allocations(uri, number, items):
+    figures = {}
+    api = iwan.ApiInstance("key", "secret", uri=uri)
+    try:
+        message = api._new_message("getBalance", "WAN")
+        message['params']['address'] = ADDRESS
+        figures["alloc_encode_balance_bytes"] = _peak(
+            lambda: api._encode(dict(message, params=dict(message['params']))), number)
+        result = MockServer(items=items).result("getTransByBlock", {"blockNumber": 4000000})
+        frame = json.dumps({"jsonrpc": "2.0", "id": 1, "result": result}, separators=(',', ':'))
+        figures["alloc_parse_trans_by_block_bytes"] = _peak(lambda: api._parse(frame), number)
+        for name, call in (("balance", lambda: api.get_balance(ADDRESS)),
+                           ("trans_by_block", lambda: api.get_trans_by_block(4000000))):
+            figures["alloc_retained_{}_bytes".format(name)] = _retained(call, number)
+    finally:
+        api.close()
+    return figures
+
+
+def _cpu(uri, number):
+    metrics = iwan.Metrics()
+    api = iwan.ApiInstance("key", "secret", uri=uri, metrics=metrics)
+    try:
+        for _ in range(number):
+            api.get_balance(ADDRESS)
+            api.get_trans_by_block(4000000)
+        message = api._new_message("getBalance", "WAN")
+        message['params']['address'] = ADDRESS
+        encode = min(timeit.repeat(lambda: api._encode(dict(message, params=dict(message['params']))),
+                                   number=2000, repeat=3)) / 2000
+    finally:
+        api.close()
+    summary = metrics.summary()
+    return {"encode_balance_us": encode * 1e6,
+            "sign_balance_us": summary["getBalance"]["sign_time_mean"] * 1e6,
+            "parse_balance_us": summary["getBalance"]["parse_time_mean"] * 1e6,
+            "parse_trans_by_block_us": summary["getTransByBlock"]["parse_time_mean"] * 1e6}
+
+
+def run(number, concurrency, pool_size, items, latency):
+    """
+    :return: Returns a dict with the run's settings and environment under "meta" and its figures under "results".
+    """
+    port = _free_port()
+    uri = "ws://127.0.0.1:{}/".format(port)
+    server = _start_server(port, items, latency)
+    try:
+        results = {}
+        results.update(_sequential(uri, "sequential_balance", lambda api: api.get_balance(ADDRESS), number))
+        results.update(_sequential(uri, "sequential_trans_by_block", lambda api: api.get_trans_by_block(4000000),
+                                   max(1, number // 10)))
+        results.update(_concurrent(uri, number * 5, concurrency, pool_size))
+        results.update(_allocations(uri, max(1, number // 20), items))
+        results.update(_cpu(uri, max(1, number // 10)))
+    finally:
+        server.terminate()
+        server.wait()
+    meta = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "platform": platform.platform(), "codec": iwan.JsonCodec.find().name, "number": number,
+            "concurrency": concurrency, "pool_size": pool_size, "items": items, "latency": latency}
+    return {"meta": meta, "results": results}
+
+
+def compare(baseline, current, tolerance):
+    """
+    Print each figure next to its baseline.
+    :return: Returns the names of the figures that got worse by more than the tolerance, a fraction.
+    """
+    regressions = []
+    for name, value in sorted(current.items()):
+        before = baseline.get(name)
+        if not before:
+            print("{:<36} {:>12.2f}".format(name, value))
+            continue
+        change = value / before - 1
+        # Throughput should go up; latencies, sizes and CPU times should go down.
+        worse = -change if name.endswith("_per_s") else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(name)
+        print("{:<36} {:>12.2f} {:>12.2f} {:>+8.1%}{}".format(name, before, value, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000, help="sequential calls per scenario")
+    parser.add_argument("--concurrency", type=int, default=200, help="calls in flight in the concurrent scenario")
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--items", type=int, default=200, help="items in list results of the mock server")
+    parser.add_argument("--latency", type=float, default=0.0, help="reply delay of the mock server in seconds")
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--compare", help="compare with the results saved in this json file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    args = parser.parse_args()
+    report = run(args.number, args.concurrency, args.pool_size, args.items, args.latency)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("{:<36} {:>12} {:>12} {:>8}".format("", "baseline", "current", "change"))
+        if compare(baseline["results"], report["results"], args.tolerance):
+            sys.exit(1)
+    else:
+        for name, value in sorted(report["results"].items()):
+            print("{:<36} {:>12.2f}".format(name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Microbenchmark of request encoding: the original sign-then-reserialize path against ApiInstance._encode.
+Run from the repository root: python benchmarks/bench_signing.py
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import iwan  # noqa: E402
+
+ERC20_ABI = [{"constant": True, "inputs": [{"name": "owner", "type": "address"}, {"name": "spender", "type": "address"}],
+              "name": "fn{}".format(i), "outputs": [{"name": "", "type": "uint256"}], "payable": False,
+              "stateMutability": "view", "type": "function"} for i in range(40)]
+
+
+def legacy_encode(api, message, now=None):
+    message['params']['timestamp'] = iwan.timestamp() if now is None else now
+    json_message = bytes(json.dumps(message, separators=(',', ':')), 'utf-8')
+    auth_code = hmac.new(bytes(api.secret_key, 'utf-8'), msg=json_message, digestmod=hashlib.sha256)
+    message['params']['signature'] = base64.b64encode(auth_code.digest()).decode()
+    return json.dumps(message, separators=(',', ':'))
+
+
+def small_message(api):
+    message = api._new_message("getBalance", "WAN")
+    message['params']['address'] = "0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"
+    return message
+
+
+def abi_message(api):
+    message = api._new_message("callScFunc", "WAN")
+    message['params']['scAddr'] = "0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"
+    message['params']['name'] = "fn0"
+    message['params']['args'] = ["0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"]
+    message['params']['abi'] = ERC20_ABI
+    return message
+
+
+def main(number=20000):
+    api = iwan.ApiInstance("key", "secret")
+    for name, build in (("small", small_message), ("abi", abi_message)):
+        message = build(api)
+        expected = json.loads(json.dumps(message))
+        wire = api._encode(message)
+        assert wire == legacy_encode(api, expected, message['params']['timestamp'])
+        legacy = min(timeit.repeat(lambda: legacy_encode(api, build(api)), number=number, repeat=3))
+        current = min(timeit.repeat(lambda: api._encode(build(api)), number=number, repeat=3))
+        print("{:<6} legacy {:8.2f} us/call  current {:8.2f} us/call  speedup {:.2f}x".format(
+            name, legacy / number * 1e6, current / number * 1e6, legacy / current))
+
+
+if __name__ == '__main__':
+    main()
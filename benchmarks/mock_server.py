@@ -0,0 +1,220 @@
+"""
+Local stand-in for the iWan websocket api, for benchmarks and offline experiments.
+Every request must carry the signature ApiInstance._make_signature computes for it with the configured secret key;
+requests with a wrong signature get an error response, as the real server does. Each method answers with a canned
+result of the right shape; list results hold a configurable number of items.
+Run from the repository root: python benchmarks/mock_server.py --port 8765 --latency 0.005 --items 100
+and connect with iwan.ApiInstance(api_key, secret_key, uri='ws://127.0.0.1:8765/').
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import random
+
+import websockets
+
+ADDRESS = "0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"
+HASH = "0x" + "5a" * 32
+
+
+def _transaction(index, block_number):
+    return {"blockHash": HASH, "blockNumber": block_number, "from": ADDRESS, "gas": 21000,
+            "gasPrice": "0x2540be400", "hash": "0x{:064x}".format(block_number * 100000 + index), "input": "0x",
+            "nonce": index, "to": ADDRESS, "transactionIndex": index, "value": "0xde0b6b3a7640000", "v": "0x1b",
+            "r": HASH, "s": HASH, "Txtype": "0x1"}
+
+
+def _log(index, block_number):
+    return {"address": ADDRESS, "topics": [HASH, "0x" + "0" * 24 + ADDRESS[2:]], "data": "0x" + "0" * 63 + "1",
+            "blockNumber": block_number, "transactionHash": HASH, "transactionIndex": index % 50, "blockHash": HASH,
+            "logIndex": index, "removed": False}
+
+
+def _staker(index):
+    return {"address": "0x{:040x}".format(index), "pubSec256": "0x04" + "ab" * 64, "pubBn256": "0x" + "cd" * 64,
+            "amount": "200000000000000000000000", "votingPower": "300000000000000000000000", "lockEpochs": 7,
+            "nextLockEpochs": 7, "from": ADDRESS, "stakingEpoch": 18000, "feeRate": 1500, "maxFeeRate": 2000,
+            "feeRateChangedEpoch": 18000, "clients": [{"address": ADDRESS, "amount": "1000000000000000000000",
+                                                      "votingPower": "1000000000000000000000", "quitEpoch": 0}],
+            "partners": []}
+
+
+class MockServer:
+    """
+    Canned iWan server. Replies are sent concurrently, each after latency seconds plus up to jitter seconds.
+    Events are pushed to the monitorEvent subscriptions made on it with push().
+    """
+    def __init__(self, secret_key="secret", latency=0.0, jitter=0.0, items=10, block_number=4000000):
+        """
+        :param secret_key: Secret key the request signatures are checked against.
+        :param latency: Seconds each reply is delayed.
+        :param jitter: Upper bound of a random extra delay per reply.
+        :param items: Number of items in list results, e.g. transactions of a block or event logs.
+        :param block_number: Height of the simulated chain.
+        """
+        self.secret_key = secret_key
+        self.latency = latency
+        self.jitter = jitter
+        self.items = items
+        self.block_number = block_number
+        self.requests = 0
+        self.rejected = 0
+        # (websocket, request id) of every monitorEvent subscription.
+        self.subscribers = []
+
+    def verify(self, message):
+        """
+        :param message: Parsed request, including its signature.
+        :return: Returns whether the signature matches the rest of the message.
+        """
+        params = message.get('params')
+        if not isinstance(params, dict) or 'signature' not in params:
+            return False
+        signature = params.pop('signature')
+        signed = bytes(json.dumps(message, separators=(',', ':')), 'utf-8')
+        expected = base64.b64encode(hmac.new(bytes(self.secret_key, 'utf-8'), msg=signed,
+                                             digestmod=hashlib.sha256).digest()).decode()
+        return hmac.compare_digest(signature, expected)
+
+    def result(self, method, params):
+        """
+        :param method: Api method of the request.
+        :param params: Params of the request.
+        :return: Returns the canned result for the method.
+        """
+        number = params.get('blockNumber', self.block_number)
+        number = number if isinstance(number, int) else self.block_number
+        if method in ("getBlockNumber", "getMaxStableBlkNumber"):
+            return self.block_number if method == "getBlockNumber" else self.block_number - 30
+        if method in ("getBlockByNumber", "getBlockByHash"):
+            return {"number": number, "hash": "0x{:064x}".format(number), "parentHash": "0x{:064x}".format(number - 1),
+                    "timestamp": 1600000000 + number * 5, "miner": ADDRESS, "difficulty": "1",
+                    "totalDifficulty": str(number), "size": 700 + 110 * self.items, "gasLimit": 1000000000,
+                    "gasUsed": 21000 * self.items, "nonce": "0x0000000000000000", "extraData": "0x",
+                    "stateRoot": HASH, "transactionsRoot": HASH, "receiptsRoot": HASH, "logsBloom": "0x" + "0" * 512,
+                    "transactions": ["0x{:064x}".format(number * 100000 + i) for i in range(self.items)],
+                    "uncles": []}
+        if method in ("getTransByBlock", "getTransByAddress", "getTransByAddressBetweenBlocks"):
+            return [_transaction(i, number) for i in range(self.items)]
+        if method == "getTxInfo":
+            return _transaction(0, self.block_number)
+        if method == "getTransactionReceipt":
+            return {"transactionHash": params.get('txHash', HASH), "transactionIndex": 0, "blockHash": HASH,
+                    "blockNumber": self.block_number, "from": ADDRESS, "to": ADDRESS, "contractAddress": None,
+                    "cumulativeGasUsed": 21000, "gasUsed": 21000, "status": "0x1", "logsBloom": "0x" + "0" * 512,
+                    "logs": [_log(i, self.block_number) for i in range(min(self.items, 10))]}
+        if method == "getScEvent":
+            return [_log(i, params.get('fromBlock', number) if isinstance(params.get('fromBlock'), int) else number)
+                    for i in range(self.items)]
+        if method in ("getCurrentStakerInfo", "getStakerInfo"):
+            return [_staker(i) for i in range(self.items)]
+        if method == "getMultiBalances":
+            return {address: "10000000000000000000" for address in params.get('address', [])}
+        if method == "getMultiTokenBalance":
+            return {address: "5000000000000000000" for address in params.get('address', [])}
+        if method == "getMultiTokenInfo":
+            return {address: {"symbol": "TKN", "decimals": "18"} for address in params.get('tokenScAddrArray', [])}
+        if method == "getTokenInfo":
+            return {"symbol": "TKN", "decimals": "18"}
+        if method in ("getBalance", "getTokenBalance", "getTokenSupply", "getTokenAllowance"):
+            return "10000000000000000000"
+        if method in ("getNonce", "getNonceIncludePending", "getBlockTransactionCount", "getTransactionConfirm"):
+            return 7
+        if method in ("getEpochID", "getEpochIDByTime"):
+            return self.block_number // 17280
+        if method in ("getSlotID", "getSlotCount"):
+            return 17280 if method == "getSlotCount" else self.block_number % 17280
+        if method == "getSlotTime":
+            return 5
+        if method == "getGasPrice":
+            return "180000000000"
+        if method == "getPosInfo":
+            return {"firstEpochId": 18000, "firstBlockNumber": 1000000}
+        if method == "getCurrentEpochInfo":
+            return {"blockNumber": self.block_number, "slotId": self.block_number % 17280,
+                    "epochId": self.block_number // 17280}
+        if method in ("sendRawTransaction", "monitorEvent"):
+            return HASH
+        if method == "importAddress":
+            return "success"
+        if method in ("callScFunc", "getScMap", "getScVar"):
+            return "10000000000000000000"
+        return [{"method": method, "index": i} for i in range(self.items)]
+
+    async def _reply(self, websocket, frame):
+        try:
+            message = json.loads(frame)
+        except ValueError:
+            return
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if not self.verify(message):
+            self.rejected += 1
+            response = {"jsonrpc": "2.0", "id": message.get('id'), "error": {"code": 401, "message": "bad signature"}}
+        else:
+            response = {"jsonrpc": "2.0", "id": message['id'],
+                        "result": self.result(message['method'], message['params'])}
+            if message['method'] == "monitorEvent":
+                self.subscribers.append((websocket, message['id']))
+        try:
+            await websocket.send(json.dumps(response, separators=(',', ':')))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def push(self, result):
+        """
+        Send an event to every subscription whose connection is still open.
+        :param result: Result of the pushed message.
+        :return: Returns the number of subscriptions the event was sent to.
+        """
+        sent = 0
+        for websocket, request_id in list(self.subscribers):
+            try:
+                await websocket.send(json.dumps({"jsonrpc": "2.0", "id": request_id, "result": result},
+                                                separators=(',', ':')))
+                sent += 1
+            except websockets.ConnectionClosed:
+                self.subscribers.remove((websocket, request_id))
+        return sent
+
+    async def handle(self, websocket):
+        tasks = set()
+        async for frame in websocket:
+            task = asyncio.ensure_future(self._reply(websocket, frame))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    def serve(self, host="127.0.0.1", port=8765):
+        """
+        :return: Returns the websockets server, to be used with async with.
+        """
+        return websockets.serve(self.handle, host, port, max_size=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--secret-key", default="secret")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each reply is delayed")
+    parser.add_argument("--jitter", type=float, default=0.0, help="upper bound of a random extra delay")
+    parser.add_argument("--items", type=int, default=10, help="number of items in list results")
+    args = parser.parse_args()
+    server = MockServer(args.secret_key, args.latency, args.jitter, args.items)
+
+    async def run():
+        async with server.serve(args.host, args.port):
+            await asyncio.Future()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
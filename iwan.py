@@ -1,11 +1,35 @@
 import asyncio
 import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import functools
 import hashlib
 import hmac
+import itertools
 import json
+import os
+import random
+import re
+import sqlite3
+import threading
 import time
+import weakref
 
 import websockets
+from websockets.protocol import State
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 
 # Utility functions #
@@ -13,38 +37,2986 @@ def timestamp():
     return int(time.time() * 1000.0)
 
 
+class ApiError(KeyError):
+    """
+    Error object returned by the server in place of a result.
+    Derives from KeyError, which is what a missing result used to raise.
+    """
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+        self.code = error.get('code') if isinstance(error, dict) else None
+
+    def __str__(self):
+        if isinstance(self.error, dict) and 'message' in self.error:
+            return str(self.error['message'])
+        return str(self.error)
+
+
+# JSON #
+# Integer literals that may be too wide for 64 bits, which orjson would silently turn into floats.
+_WIDE_INT = re.compile(r'[:\[,]\s*-?\d{19}')
+_WIDE_INT_BYTES = re.compile(_WIDE_INT.pattern.encode())
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+class JsonCodec:
+    """
+    The JSON functions used to decode responses and to serialize results, e.g. for raw calls and models.
+    Request params are always encoded with the stdlib json, whose output is what the server checks signatures
+    against. Values a fast codec cannot represent exactly, such as integers wider than 64 bits, are left to the
+    stdlib json.
+    """
+    def __init__(self, name, loads, dumps):
+        """
+        :param name: Name of the codec.
+        :param loads: Function parsing a str or bytes document.
+        :param dumps: Function serializing a value to compact text.
+        """
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return "JsonCodec({!r})".format(self.name)
+
+    @classmethod
+    def named(cls, name):
+        """
+        :param name: One of "orjson", "ujson" or "json".
+        :return: Returns the codec, raising ImportError if its library is not installed.
+        """
+        if name == "json":
+            return cls("json", json.loads, _stdlib_dumps)
+        if name == "orjson":
+            if orjson is None:
+                raise ImportError("orjson is not installed")
+            return cls("orjson", _orjson_loads, _orjson_dumps)
+        if name == "ujson":
+            if ujson is None:
+                raise ImportError("ujson is not installed")
+            return cls("ujson", _ujson_loads, _ujson_dumps)
+        raise ValueError("unknown json codec {!r}".format(name))
+
+    @classmethod
+    def find(cls):
+        """
+        :return: Returns the fastest codec installed: orjson, then ujson, then the stdlib json.
+        """
+        for name in ("orjson", "ujson"):
+            try:
+                return cls.named(name)
+            except ImportError:
+                pass
+        return cls.named("json")
+
+
+def _orjson_loads(document):
+    if (_WIDE_INT if isinstance(document, str) else _WIDE_INT_BYTES).search(document):
+        return json.loads(document)
+    return orjson.loads(document)
+
+
+def _orjson_dumps(obj):
+    try:
+        text = orjson.dumps(obj)
+    except TypeError:
+        return _stdlib_dumps(obj)
+    return text.decode()
+
+
+def _ujson_loads(document):
+    try:
+        return ujson.loads(document)
+    except (ValueError, OverflowError):
+        return json.loads(document)
+
+
+def _ujson_dumps(obj):
+    try:
+        return ujson.dumps(obj, escape_forward_slashes=False)
+    except (TypeError, OverflowError):
+        return _stdlib_dumps(obj)
+
+
+# Connection handling #
+_RESPONSE_ID = re.compile(r'\{\s*"jsonrpc"\s*:\s*"2\.0"\s*,\s*"id"\s*:\s*(\d+)')
+_RESULT = re.compile(r'\{\s*"jsonrpc"\s*:\s*"2\.0"\s*,\s*"id"\s*:\s*\d+\s*,\s*"result"\s*:\s*')
+
+
+def _response_id(frame):
+    match = _RESPONSE_ID.match(frame) if isinstance(frame, str) else None
+    if match is not None:
+        return int(match.group(1))
+    try:
+        return json.loads(frame).get('id')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _message_too_big(exc):
+    # Close code 1009: a reply exceeded max_size, and would again if the request were resent.
+    return isinstance(exc, websockets.ConnectionClosed) and any(
+        frame is not None and frame.code == 1009 for frame in (exc.rcvd, exc.sent))
+
+
+class _Connection:
+    """
+    One websocket shared by many in-flight requests. Replies are routed back to their request by JSON-RPC id.
+    """
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.pending = {}
+        self.subscriptions = {}
+        self.last_used = time.monotonic()
+        # Task pinging the connection before it is reused after an idle period, or None.
+        self.checking = None
+        self._reader = asyncio.ensure_future(self._read())
+
+    @property
+    def open(self):
+        return self.websocket.state is State.OPEN
+
+    async def _read(self):
+        error = ConnectionResetError("websocket connection closed")
+        try:
+            async for frame in self.websocket:
+                request_id = _response_id(frame)
+                future = self.pending.pop(request_id, None)
+                if future is not None:
+                    if not future.done():
+                        future.set_result(frame)
+                elif request_id in self.subscriptions:
+                    await self.subscriptions[request_id].push(frame)
+        except websockets.ConnectionClosed as exc:
+            error = exc
+        finally:
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def send(self, request_id, payload):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self.websocket.send(payload)
+        except BaseException:
+            self.pending.pop(request_id, None)
+            raise
+        return future
+
+    async def wait(self, request_id, future):
+        try:
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+            self.last_used = time.monotonic()
+
+    async def wait_closed(self):
+        await asyncio.wait([self._reader])
+
+    async def ping(self, timeout):
+        try:
+            await asyncio.wait_for(await self.websocket.ping(), timeout)
+            return True
+        except (asyncio.TimeoutError, websockets.ConnectionClosed):
+            return False
+
+    async def close(self):
+        await self.websocket.close()
+        self._reader.cancel()
+
+
+class ConnectionPool:
+    """
+    Bounded pool of long-lived websocket connections to a single endpoint.
+    Requests are multiplexed over the open connections; another connection is opened only when every open one is
+    busy. Dropped connections are replaced on the next request.
+    A pool is bound to the event loop it is first used on.
+    """
+    def __init__(self, endpoint, size=4, ping_interval=20.0, ping_timeout=20.0, open_timeout=10.0, max_size=2 ** 26):
+        """
+        :param endpoint: Full websocket url, including the api key.
+        :param size: Maximum number of open connections.
+        :param ping_interval: Connections idle for longer than this many seconds are pinged before reuse.
+        :param ping_timeout: Seconds to wait for a pong before a connection is considered dead.
+        :param open_timeout: Seconds to wait for the opening handshake.
+        :param max_size: Largest message accepted, in bytes, or None for no limit. A larger reply closes its
+        connection with code 1009, failing every request in flight on it.
+        """
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self.endpoint = endpoint
+        self.size = size
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.open_timeout = open_timeout
+        self.max_size = max_size
+        self.opened = 0
+        self.reused = 0
+        self._connections = []
+        self._opening = set()
+
+    async def _handshake(self):
+        websocket = await websockets.connect(self.endpoint, ping_interval=self.ping_interval,
+                                             ping_timeout=self.ping_timeout, open_timeout=self.open_timeout,
+                                             max_size=self.max_size)
+        return _Connection(websocket)
+
+    async def _connect(self):
+        connection = await self._handshake()
+        self._connections.append(connection)
+        self.opened += 1
+        return connection
+
+    async def _discard(self, connection):
+        if connection in self._connections:
+            self._connections.remove(connection)
+        await connection.close()
+
+    def _open(self):
+        opening = asyncio.ensure_future(self._connect())
+        self._opening.add(opening)
+        opening.add_done_callback(self._opening.discard)
+        opening.add_done_callback(_retrieve)
+        return opening
+
+    async def _check(self, connection):
+        try:
+            if await connection.ping(self.ping_timeout):
+                connection.last_used = time.monotonic()
+            else:
+                await self._discard(connection)
+        finally:
+            connection.checking = None
+
+    async def _acquire(self):
+        # Let the loop process disconnects that arrived while it was not running.
+        await asyncio.sleep(0)
+        # A connection is chosen without awaiting anything, so no lock is needed. Handshakes and pings run in tasks,
+        # which other requests wait for only when there is no other connection they can use.
+        while True:
+            for connection in [c for c in self._connections if not c.open and c.checking is None]:
+                await self._discard(connection)
+            connection = min((c for c in self._connections if c.checking is None), key=lambda c: len(c.pending),
+                             default=None)
+            room = len(self._connections) + len(self._opening) < self.size
+            if connection is None and room and not self._opening:
+                # A request giving up during the handshake leaves the new connection to the pool.
+                return await asyncio.shield(self._open())
+            if connection is None:
+                # Requests wait for a handshake already under way rather than each opening a connection, so they
+                # are still sent in the order they were made.
+                await asyncio.wait(self._opening | {c.checking for c in self._connections if c.checking is not None},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                continue
+            if connection.pending and room:
+                # Every open connection is busy: another one joins the pool when it is ready, while requests stay on
+                # the open ones meanwhile.
+                self._open()
+            idle = not connection.pending and time.monotonic() - connection.last_used
+            if self.ping_interval is None or not idle or idle <= self.ping_interval:
+                self.reused += 1
+                return connection
+            connection.checking = asyncio.ensure_future(self._check(connection))
+            connection.checking.add_done_callback(_retrieve)
+            await asyncio.wait([connection.checking])
+            if connection in self._connections and connection.open:
+                self.reused += 1
+                return connection
+
+    async def request(self, request_id, payload):
+        """
+        Send one message and wait for the reply carrying the same id.
+        A request that could not be written because the connection had dropped is sent once more on a fresh one;
+        a request that was written is never resent.
+        :param request_id: JSON-RPC id of the message.
+        :param payload: Serialized message.
+        :return: Raw response message.
+        """
+        connection = await self._acquire()
+        try:
+            future = await connection.send(request_id, payload)
+        except websockets.ConnectionClosed:
+            await self._discard(connection)
+            connection = await self._acquire()
+            future = await connection.send(request_id, payload)
+        return await connection.wait(request_id, future)
+
+    async def close(self):
+        """
+        Close every connection held by the pool.
+        """
+        for opening in self._opening:
+            opening.cancel()
+        connections, self._connections = self._connections, []
+        await asyncio.gather(*(connection.close() for connection in connections), return_exceptions=True)
+
+
+class _Health:
+    __slots__ = ('latency', 'error_rate', 'failures', 'ejected_until', 'ejections', 'in_flight', 'requests')
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.in_flight = 0
+        self.requests = 0
+
+
+class EndpointRouter:
+    """
+    Routes requests over several endpoints serving the same api, each with its own ConnectionPool.
+    A moving average of latency and error rate is kept per endpoint. Reads go to the least busy of the healthy
+    endpoints that are about as fast as the fastest one; writes stick to the primary, the first healthy endpoint in
+    the list. An endpoint failing repeatedly is ejected for a while, then tried again.
+    """
+    def __init__(self, endpoints, size=4, alpha=0.2, tolerance=0.5, max_failures=3, max_error_rate=0.5,
+                 eject_time=10.0, max_eject_time=120.0, **options):
+        """
+        :param endpoints: Full websocket urls, including the api key, the primary first.
+        :param size: Maximum number of open connections per endpoint.
+        :param alpha: Weight of the newest sample in the latency and error rate averages.
+        :param tolerance: Reads are spread over endpoints at most this fraction slower than the fastest one.
+        :param max_failures: Consecutive failures after which an endpoint is ejected.
+        :param max_error_rate: Average error rate above which an endpoint is ejected.
+        :param eject_time: Seconds an endpoint is first ejected for; doubled on each further ejection.
+        :param max_eject_time: Upper bound on the ejection time.
+        :param options: Passed to each ConnectionPool.
+        """
+        if not endpoints:
+            raise ValueError("at least one endpoint is required")
+        self.pools = [ConnectionPool(endpoint, size=size, **options) for endpoint in endpoints]
+        self.alpha = alpha
+        self.tolerance = tolerance
+        self.max_failures = max_failures
+        self.max_error_rate = max_error_rate
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self._health = {pool: _Health() for pool in self.pools}
+
+    def _healthy(self):
+        now = time.monotonic()
+        healthy = [pool for pool in self.pools if self._health[pool].ejected_until <= now]
+        # With every endpoint ejected, the one coming back first is still better than failing outright.
+        return healthy or [min(self.pools, key=lambda pool: self._health[pool].ejected_until)]
+
+    @property
+    def primary(self):
+        """
+        Pool of the endpoint writes and subscriptions currently go to.
+        """
+        return self._healthy()[0]
+
+    def select(self, write=False):
+        """
+        :param write: Whether the request changes state and must go to the primary.
+        :return: Returns the pool the next request should be sent on.
+        """
+        healthy = self._healthy()
+        if write or len(healthy) == 1:
+            return healthy[0]
+        # Endpoints without samples yet count as fastest, so they get measured.
+        latencies = {pool: self._health[pool].latency or 0.0 for pool in healthy}
+        limit = min(latencies.values()) * (1 + self.tolerance)
+        return min((pool for pool in healthy if latencies[pool] <= limit),
+                   key=lambda pool: (self._health[pool].in_flight, latencies[pool]))
+
+    def _record(self, pool, latency, error):
+        health = self._health[pool]
+        now = time.monotonic()
+        if error and health.ejected_until > now:
+            # Requests sent before the ejection are still failing; that is not news about the endpoint.
+            return
+        health.latency = latency if health.latency is None else health.latency + self.alpha * (latency - health.latency)
+        health.error_rate += self.alpha * (error - health.error_rate)
+        if not error:
+            health.failures = 0
+            return
+        health.failures += 1
+        if health.failures >= self.max_failures or health.error_rate > self.max_error_rate:
+            health.ejected_until = now + min(self.eject_time * 2 ** health.ejections, self.max_eject_time)
+            health.ejections += 1
+            health.failures = 0
+            health.error_rate = self.max_error_rate / 2
+
+    async def request(self, request_id, payload, write=False, timeout=None):
+        """
+        Send one message on the selected endpoint and wait for the reply carrying the same id.
+        :param request_id: JSON-RPC id of the message.
+        :param payload: Serialized message.
+        :param write: Whether the request changes state and must go to the primary.
+        :param timeout: Seconds after which the request fails with asyncio.TimeoutError, counted against the
+        endpoint; None to wait forever.
+        :return: Raw response message.
+        """
+        pool = self.select(write)
+        health = self._health[pool]
+        health.in_flight += 1
+        health.requests += 1
+        started = time.monotonic()
+        try:
+            if timeout is None:
+                response = await pool.request(request_id, payload)
+            else:
+                response = await asyncio.wait_for(pool.request(request_id, payload), timeout)
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            self._record(pool, time.monotonic() - started, 1.0)
+            raise
+        except asyncio.CancelledError:
+            # A call abandoned on its deadline still shows the endpoint is at least this slow.
+            elapsed = time.monotonic() - started
+            if health.latency is not None and elapsed > health.latency:
+                self._record(pool, elapsed, 0.0)
+            raise
+        finally:
+            health.in_flight -= 1
+        self._record(pool, time.monotonic() - started, 0.0)
+        if health.ejections and health.error_rate < self.max_error_rate / 10:
+            health.ejections = 0
+        return response
+
+    def stats(self):
+        """
+        :return: Returns a dict per endpoint with its average latency, error rate, requests sent and in flight, and
+        the seconds left until an ejected endpoint is used again.
+        """
+        now = time.monotonic()
+        return {pool.endpoint: {"latency": health.latency, "error_rate": health.error_rate,
+                                "requests": health.requests, "in_flight": health.in_flight,
+                                "ejected": max(0.0, health.ejected_until - now)}
+                for pool, health in self._health.items()}
+
+    async def close(self):
+        """
+        Close the connections to every endpoint.
+        """
+        await asyncio.gather(*(pool.close() for pool in self.pools))
+
+
+# Caching #
+_MISSING = object()
+
+
+def _retrieve(future):
+    # Marks the exception of a shared request as retrieved when every caller waiting on it was cancelled.
+    if not future.cancelled():
+        future.exception()
+
+
+async def _within(context, coroutine):
+    # A task runs in a copy of the context it is created in, so creating it in the caller's context carries
+    # contextvars such as the options() policy over to the loop thread.
+    return await context.run(asyncio.ensure_future, coroutine)
+
+
+def _to_int(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value, 0)
+        except ValueError:
+            return None
+    return None
+
+
+class _LruCache:
+    """
+    Bounded LRU of results stored as JSON text, so every hit returns a fresh copy.
+    Subclasses list the methods they apply to and decide in admit() which results may be stored.
+    """
+    METHODS = frozenset()
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, message):
+        if message['method'] not in self.METHODS:
+            return None
+        return json.dumps([message['method'], message['params']], sort_keys=True, separators=(',', ':'))
+
+    def get(self, key):
+        with self._lock:
+            value = self._load(key)
+            if value is None:
+                self.misses += 1
+                return _MISSING
+            self.hits += 1
+        return json.loads(value)
+
+    def revalidate(self, key):
+        return False
+
+    async def admit(self, api, message, result):
+        return result is not None
+
+    def put(self, key, result, text=None):
+        value = text if text is not None else json.dumps(result, separators=(',', ':'))
+        with self._lock:
+            self._store(key, value)
+
+    def _load(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._entries[key] = value
+        self.size += len(value)
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            self.size -= len(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class PosHistoryCache(_LruCache):
+    """
+    Permanent cache for POS queries about epochs that have already ended, whose results never change.
+    Entries are kept in a bounded in-memory LRU and, when a path is given, in a sqlite database that survives
+    restarts and is shared with other processes using the same file.
+    Queries about the current or a future epoch are never stored.
+    """
+    METHODS = frozenset(["getActivity", "getEpochLeadersByEpochID", "getRandomProposersByEpochID",
+                         "getLeaderGroupByEpochID", "getEpochIncentivePayDetail", "getEpochStakeOut",
+                         "getSlotActivity", "getValidatorActivity", "getRandom"])
+
+    def __init__(self, max_entries=4096, path=None, epoch_refresh=60.0):
+        """
+        :param max_entries: Maximum number of results kept in memory.
+        :param path: Optional sqlite database file for persistent storage.
+        :param epoch_refresh: Minimum number of seconds between getEpochID calls made to tell past epochs apart.
+        """
+        super().__init__(max_entries)
+        self.path = path
+        self.epoch_refresh = epoch_refresh
+        self._epochs = {}
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS pos_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._db.commit()
+
+    def key(self, message):
+        params = message['params']
+        if not isinstance(params.get('epochID'), int) or params.get('blockNumber') == -1:
+            return None
+        return super().key(message)
+
+    async def admit(self, api, message, result):
+        if result is None:
+            return False
+        params = message['params']
+        chain_type = params.get('chainType')
+        epoch_id = params['epochID']
+        current, checked = self._epochs.get(chain_type, (None, 0.0))
+        if current is None or (epoch_id >= current and time.monotonic() - checked > self.epoch_refresh):
+            current = _to_int(await api._fetch(api._new_message("getEpochID", chain_type)))
+            self._epochs[chain_type] = (current, time.monotonic())
+        return current is not None and epoch_id < current
+
+    def _load(self, key):
+        value = super()._load(key)
+        if value is None and self._db is not None:
+            row = self._db.execute("SELECT value FROM pos_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value = row[0]
+                super()._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        super()._store(key, value)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO pos_cache (key, value) VALUES (?, ?)", (key, value))
+            self._db.commit()
+
+    def clear(self):
+        """
+        Drop every entry, including the persisted ones.
+        """
+        super().clear()
+        with self._lock:
+            if self._db is not None:
+                self._db.execute("DELETE FROM pos_cache")
+                self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class FinalityCache(_LruCache):
+    """
+    Cache for blocks, transactions and receipts that are at or below the highest stable block, which can no longer
+    be rolled back. Lookups are keyed by chain type and block number or hash; anything newer than the stable block
+    is always fetched from the server.
+    """
+    METHODS = frozenset(["getBlockByHash", "getBlockByNumber", "getTransByBlock", "getTxInfo",
+                         "getTransactionReceipt"])
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, stable_refresh=5.0):
+        """
+        :param max_entries: Maximum number of results kept.
+        :param max_bytes: Maximum total size of the kept results, measured as serialized JSON.
+        :param stable_refresh: Minimum number of seconds between getMaxStableBlkNumber calls.
+        """
+        super().__init__(max_entries, max_bytes)
+        self.stable_refresh = stable_refresh
+        self._stable = {}
+
+    @staticmethod
+    def block_number(message, result):
+        """
+        Find the number of the block a result belongs to.
+        :return: Returns the block number, or None when it can not be told.
+        """
+        method = message['method']
+        if method in ("getBlockByNumber", "getTransByBlock") and 'blockNumber' in message['params']:
+            return _to_int(message['params']['blockNumber'])
+        if method == "getTransByBlock":
+            return _to_int(result[0].get('blockNumber')) if result else None
+        if method == "getBlockByHash":
+            return _to_int(result.get('number'))
+        return _to_int(result.get('blockNumber'))
+
+    async def admit(self, api, message, result):
+        if not isinstance(result, (dict, list)):
+            return False
+        number = self.block_number(message, result)
+        if number is None:
+            return False
+        chain_type = message['params'].get('chainType')
+        stable, checked = self._stable.get(chain_type, (None, 0.0))
+        if (stable is None or number > stable) and time.monotonic() - checked > self.stable_refresh:
+            try:
+                fetched = _to_int(await api._fetch(api._new_message("getMaxStableBlkNumber", chain_type)))
+            except (ApiError, OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                fetched = None
+            # A failed lookup keeps the last known height and is not repeated for every result.
+            stable = fetched if fetched is not None else stable
+            self._stable[chain_type] = (stable, time.monotonic())
+        return stable is not None and number <= stable
+
+
+class TokenInfoCache(_LruCache):
+    """
+    Long-lived cache for token metadata from getTokenInfo, such as symbol and decimals, which does not change.
+    """
+    METHODS = frozenset(["getTokenInfo"])
+
+    def __init__(self, max_entries=10000):
+        """
+        :param max_entries: Maximum number of tokens kept.
+        """
+        super().__init__(max_entries)
+
+
+class TtlCache:
+    """
+    Short-lived cache for hot values that change often, such as the block number or gas price.
+    Each entry lives for the ttl of its method, optionally per chain type. With a stale window, an expired value is
+    still returned for that many seconds while a single background request refreshes it.
+    """
+    TTLS = {"getBlockNumber": 1.0, "getGasPrice": 5.0, "getCoin2WanRatio": 60.0, "getToken2WanRatio": 60.0,
+            "getCurrentEpochInfo": 5.0}
+
+    def __init__(self, ttls=None, stale=0.0, max_entries=1024):
+        """
+        :param ttls: Seconds each result stays fresh, keyed by method name or by (method name, chain type). Merged
+        over TTLS; a ttl of 0 disables caching for that key.
+        :param stale: Seconds past expiry during which the old value is returned while it is being refreshed.
+        :param max_entries: Maximum number of results kept.
+        """
+        self.ttls = dict(self.TTLS)
+        self.ttls.update(ttls or {})
+        self.stale = stale
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl(self, method, chain_type):
+        ttl = self.ttls.get((method, chain_type))
+        if ttl is None:
+            ttl = self.ttls.get(method, 0.0)
+        return ttl
+
+    def key(self, message):
+        method = message['method']
+        params = message['params']
+        chain_type = params.get('chainType', params.get('crossChain'))
+        if not self.ttl(method, chain_type) > 0:
+            return None
+        return method, chain_type, json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() > entry[1] + self.stale:
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return json.loads(entry[0])
+
+    def revalidate(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() <= entry[1] or key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    async def admit(self, api, message, result):
+        return True
+
+    def put(self, key, result, text=None):
+        value = text if text is not None else json.dumps(result, separators=(',', ':'))
+        with self._lock:
+            self._refreshing.discard(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl(key[0], key[1]))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._refreshing.clear()
+
+
+# Streams #
+class _Stream:
+    """
+    Iterable with both for and async for; synchronous iteration runs on the event loop of the instance.
+    """
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self.api._run(self.__anext__())
+        except StopAsyncIteration:
+            raise StopIteration
+
+    def __aiter__(self):
+        return self
+
+
+# Rate limiting #
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RateLimiter:
+    """
+    Client-side limit on the requests sent with one api key: a token bucket caps the request rate and an AIMD
+    limit caps the requests in flight. The concurrency limit is halved (at most once per cooldown) when a request
+    fails with an error response or a transport error, and grows by about one per limit successful requests.
+    A limiter may be shared by several instances, threads and event loops; RateLimiter.for_key() returns the one
+    shared by every caller using the same key.
+    """
+    _shared = weakref.WeakValueDictionary()
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rate=10.0, burst=None, concurrency=16, min_concurrency=1, max_concurrency=256, backoff=0.5,
+                 cooldown=1.0):
+        """
+        :param rate: Requests per second allowed on average, or None for no rate limit.
+        :param burst: Requests that may be sent at once after an idle period; by default rate.
+        :param concurrency: Initial limit of requests in flight.
+        :param min_concurrency: Lowest limit the backoff goes to.
+        :param max_concurrency: Highest limit the ramp up goes to.
+        :param backoff: Factor the limit is multiplied by on failure.
+        :param cooldown: Minimum number of seconds between two decreases.
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 1.0)
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.waiting_for_rate = 0
+        self.waiting_for_concurrency = 0
+        self.throttled = 0
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._decreased = 0.0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_key(cls, api_key, **options):
+        """
+        Get the limiter shared by everything using api_key, creating it with options if there is none yet.
+        """
+        with cls._shared_lock:
+            limiter = cls._shared.get(api_key)
+            if limiter is None:
+                limiter = cls._shared[api_key] = cls(**options)
+            return limiter
+
+    def stats(self):
+        """
+        :return: Returns the current limits, requests in flight and requests waiting for the rate or concurrency.
+        """
+        with self._lock:
+            tokens = self._tokens
+            if self.rate is not None:
+                tokens = min(self.burst, tokens + (time.monotonic() - self._refilled) * self.rate)
+            return {'rate': self.rate, 'tokens': tokens, 'concurrency': int(self.limit),
+                    'in_flight': self.in_flight, 'waiting_for_rate': self.waiting_for_rate,
+                    'waiting_for_concurrency': self.waiting_for_concurrency, 'throttled': self.throttled}
+
+    async def acquire(self):
+        delay = 0.0
+        with self._lock:
+            if self.rate is not None:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    delay = -self._tokens / self.rate
+                    self.waiting_for_rate += 1
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                with self._lock:
+                    self.waiting_for_rate -= 1
+        with self._lock:
+            if self.in_flight < int(self.limit) and not self._waiters:
+                self.in_flight += 1
+                return
+            loop = asyncio.get_running_loop()
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+            self.waiting_for_concurrency += 1
+        try:
+            await waiter[1]
+        except BaseException:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    # A slot was handed over just before cancellation; pass it on.
+                    self.in_flight -= 1
+                    self._wake()
+            raise
+        finally:
+            with self._lock:
+                self.waiting_for_concurrency -= 1
+
+    def release(self, ok):
+        """
+        Return a slot taken by acquire().
+        :param ok: True when the request succeeded, False when it failed in a way that suggests overload, None when
+        it tells nothing about the server, e.g. it was cancelled.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if ok:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            elif ok is not None:
+                self.throttled += 1
+                now = time.monotonic()
+                if now - self._decreased >= self.cooldown:
+                    self.limit = max(self.min_concurrency, self.limit * self.backoff)
+                    self._decreased = now
+            self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            loop, future = self._waiters.popleft()
+            self.in_flight += 1
+            loop.call_soon_threadsafe(_wake, future)
+
+
+# Metrics #
+class _Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Interpolated within the bucket holding the rank, as Prometheus' histogram_quantile does.
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Records per-method latency, request and response size, signing and parsing time histograms and error counts of
+    the calls made by the instances it is passed to, and the connections opened and reused by their pools.
+    The on_request, on_response and on_error hooks can be extended in a subclass, e.g. to emit tracing spans.
+    An instance without metrics does no timing at all.
+    """
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+    CPU_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+
+    def __init__(self):
+        self.latency = collections.defaultdict(lambda: _Histogram(self.LATENCY_BUCKETS))
+        self.request_size = collections.defaultdict(lambda: _Histogram(self.SIZE_BUCKETS))
+        self.response_size = collections.defaultdict(lambda: _Histogram(self.SIZE_BUCKETS))
+        self.sign_time = collections.defaultdict(lambda: _Histogram(self.CPU_BUCKETS))
+        self.parse_time = collections.defaultdict(lambda: _Histogram(self.CPU_BUCKETS))
+        self.errors = collections.Counter()
+        self._pools = weakref.WeakSet()
+
+    def track(self, pool):
+        """
+        Include the connection counts of a ConnectionPool.
+        :param pool: The pool to report on.
+        """
+        self._pools.add(pool)
+
+    def on_request(self, method, request_id, size, sign_time):
+        """
+        Called when a message has been signed and is about to be sent.
+        :param method: Api method of the message.
+        :param request_id: JSON-RPC id of the message.
+        :param size: Length of the serialized message.
+        :param sign_time: Seconds spent computing the signature.
+        """
+        self.request_size[method].observe(size)
+        self.sign_time[method].observe(sign_time)
+
+    def on_response(self, method, request_id, latency, size, parse_time):
+        """
+        Called when a reply has been received and parsed.
+        :param method: Api method of the message.
+        :param request_id: JSON-RPC id of the message.
+        :param latency: Seconds from the start of the attempt to the parsed reply.
+        :param size: Length of the reply.
+        :param parse_time: Seconds spent parsing the reply.
+        """
+        self.latency[method].observe(latency)
+        self.response_size[method].observe(size)
+        self.parse_time[method].observe(parse_time)
+
+    def on_error(self, method, request_id, latency, error):
+        """
+        Called when an attempt fails with an error response or a transport error.
+        :param method: Api method of the message.
+        :param request_id: JSON-RPC id of the message.
+        :param latency: Seconds from the start of the attempt to the failure.
+        :param error: The exception raised.
+        """
+        self.errors[method, type(error).__name__] += 1
+
+    def _connections(self):
+        counts = collections.defaultdict(lambda: [0, 0])
+        for pool in list(self._pools):
+            # The endpoint url ends with the api key, which does not belong in metrics.
+            endpoint = pool.endpoint.rsplit('/', 1)[0] + '/'
+            counts[endpoint][0] += pool.opened
+            counts[endpoint][1] += pool.reused
+        return counts
+
+    def summary(self):
+        """
+        :return: Returns a dict per method with its call and error counts, latency percentiles and mean sizes and
+        CPU times, and a "connections" entry with the connections opened and reused per endpoint.
+        """
+        summary = {}
+        for method in set(self.latency) | set(self.request_size) | {method for method, _ in self.errors}:
+            latency = self.latency.get(method) or _Histogram(self.LATENCY_BUCKETS)
+            summary[method] = {
+                "calls": latency.count,
+                "errors": sum(count for (name, _), count in self.errors.items() if name == method),
+                "latency_p50": latency.quantile(0.5),
+                "latency_p99": latency.quantile(0.99),
+                "latency_mean": latency.sum / latency.count if latency.count else None,
+            }
+            for name, histograms in (("request_size", self.request_size), ("response_size", self.response_size),
+                                     ("sign_time", self.sign_time), ("parse_time", self.parse_time)):
+                histogram = histograms.get(method)
+                summary[method][name + "_mean"] = histogram.sum / histogram.count if histogram else None
+        summary["connections"] = {endpoint: {"opened": opened, "reused": reused}
+                                  for endpoint, (opened, reused) in self._connections().items()}
+        return summary
+
+    def prometheus(self):
+        """
+        :return: Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, description, histograms in (
+                ("iwan_request_duration_seconds", "Latency of api calls.", self.latency),
+                ("iwan_request_size_bytes", "Size of signed request messages.", self.request_size),
+                ("iwan_response_size_bytes", "Size of response messages.", self.response_size),
+                ("iwan_sign_duration_seconds", "Time spent signing requests.", self.sign_time),
+                ("iwan_parse_duration_seconds", "Time spent parsing responses.", self.parse_time)):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} histogram".format(name))
+            for method, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{{method="{}",le="{}"}} {}'.format(name, _label(method), le, cumulative))
+                lines.append('{}_sum{{method="{}"}} {!r}'.format(name, _label(method), float(histogram.sum)))
+                lines.append('{}_count{{method="{}"}} {}'.format(name, _label(method), histogram.count))
+        lines.append("# HELP iwan_errors_total Failed api call attempts.")
+        lines.append("# TYPE iwan_errors_total counter")
+        for (method, kind), count in sorted(self.errors.items()):
+            lines.append('iwan_errors_total{{method="{}",kind="{}"}} {}'.format(_label(method), _label(kind), count))
+        connections = sorted(self._connections().items())
+        for index, (name, description) in enumerate((("iwan_connections_opened_total", "Connections opened."),
+                                                     ("iwan_connections_reused_total", "Connections reused."))):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} counter".format(name))
+            for endpoint, counts in connections:
+                lines.append('{}{{endpoint="{}"}} {}'.format(name, _label(endpoint), counts[index]))
+        return "\n".join(lines) + "\n"
+
+
+# Call policy #
+_POLICY = contextvars.ContextVar('iwan_policy', default=(None, None))
+
+
+class CallPolicy:
+    """
+    Deadline, retry and hedging settings applied to each api call.
+    A call fails with asyncio.TimeoutError once timeout seconds have passed, retries included. Calls that fail
+    with a transport error or an attempt timeout are retried with jittered exponential backoff, except methods in
+    NON_IDEMPOTENT, which are never sent twice. Methods in hedge get a second request when the first is slower than
+    the hedge_percentile of their recent latencies; the first reply wins.
+    With raw set, calls return the result as the bytes sent by the server, without parsing it, and bypass caches
+    and coalescing. With typed set, results of the methods in MODELS are returned as model objects.
+    """
+    NON_IDEMPOTENT = frozenset(["sendRawTransaction", "importAddress", "monitorEvent"])
+    LATENCY_CRITICAL = frozenset(["getBalance", "getNonceIncludePending"])
+
+    def __init__(self, timeout=30.0, retries=2, attempt_timeout=None, backoff=0.1, max_backoff=2.0, hedge=(),
+                 hedge_percentile=0.95, hedge_min_samples=20, raw=False, typed=False):
+        """
+        :param timeout: Seconds allowed for a call, or None to wait forever.
+        :param retries: Number of times a failed idempotent call is sent again.
+        :param attempt_timeout: Seconds allowed for each attempt before it counts as failed, or None.
+        :param backoff: Base delay in seconds before a retry; doubled for each further retry.
+        :param max_backoff: Upper bound of the delay before a retry.
+        :param hedge: Methods that are hedged, e.g. CallPolicy.LATENCY_CRITICAL. Methods in NON_IDEMPOTENT are
+        left out.
+        :param hedge_percentile: Latency percentile after which the second request is sent.
+        :param hedge_min_samples: Number of latencies measured for a method before it is hedged.
+        :param raw: Whether calls return the unparsed result bytes.
+        :param typed: Whether results are returned as Block, Transaction, Receipt, Log or StakerInfo objects.
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.attempt_timeout = attempt_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Hedging sends a second request, which methods that change state must never get.
+        self.hedge = frozenset(hedge) - self.NON_IDEMPOTENT
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.raw = raw
+        self.typed = typed
+
+    def replace(self, **changes):
+        """
+        :return: Returns a copy of the policy with the given settings changed.
+        """
+        policy = copy.copy(self)
+        for name, value in changes.items():
+            if not hasattr(policy, name):
+                raise TypeError("unknown call policy setting '{}'".format(name))
+            setattr(policy, name, frozenset(value) - self.NON_IDEMPOTENT if name == 'hedge' else value)
+        return policy
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+# Coalescing #
+def _lookup(result, key):
+    if not isinstance(result, dict):
+        return _MISSING
+    if key in result:
+        return result[key]
+    if isinstance(key, str):
+        folded = key.lower()
+        for name, value in result.items():
+            if isinstance(name, str) and name.lower() == folded:
+                return value
+    return _MISSING
+
+
+class Coalescer:
+    """
+    Dataloader-style batching of single-item calls into the multi-item method of the api.
+    Calls with the same method and group parameters made within window seconds of each other are sent as one
+    multi-item request, or sooner once max_batch items are waiting, and each caller gets its own item back. A call
+    that ends up alone, or whose item is missing from the multi-item result, is sent as the original call.
+    RULES maps a method to (multi-item method, group parameters, item parameter, multi-item parameter).
+    """
+    RULES = {
+        "getBalance": ("getMultiBalances", ("chainType",), "address", "address"),
+        "getTokenBalance": ("getMultiTokenBalance", ("chainType", "tokenScAddr"), "address", "address"),
+        "getTokenInfo": ("getMultiTokenInfo", ("chainType",), "tokenScAddr", "tokenScAddrArray"),
+    }
+
+    def __init__(self, window=0.002, max_batch=100, methods=None):
+        """
+        :param window: Seconds a call waits for others to join its batch.
+        :param max_batch: Maximum number of items per multi-item request.
+        :param methods: Methods to coalesce; by default every method in RULES.
+        """
+        self.window = window
+        self.max_batch = max_batch
+        self.rules = {method: rule for method, rule in self.RULES.items() if methods is None or method in methods}
+        self.requests = 0
+        self.items = 0
+        self._batches = {}
+        self._timers = {}
+
+    async def load(self, api, message):
+        """
+        Wait for the item of a single-item call from a shared multi-item request.
+        :return: Returns the item, or _MISSING when the call must be sent on its own.
+        """
+        method = message['method']
+        _, group_params, item_param, _ = self.rules[method]
+        params = message['params']
+        group = (method,) + tuple(params.get(name) for name in group_params)
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(group)
+        if batch is None:
+            batch = self._batches[group] = {}
+            self._timers[group] = loop.call_later(self.window, self._flush, api, group)
+        item = params[item_param]
+        future = batch.get(item)
+        if future is None:
+            future = batch[item] = loop.create_future()
+        if len(batch) >= self.max_batch:
+            self._flush(api, group)
+        return await asyncio.shield(future)
+
+    def _flush(self, api, group):
+        batch = self._batches.pop(group, None)
+        if batch is None:
+            return
+        self._timers.pop(group).cancel()
+        if len(batch) == 1:
+            for future in batch.values():
+                future.set_result(_MISSING)
+            return
+        task = asyncio.ensure_future(self._load_many(api, group, batch))
+        task.add_done_callback(_retrieve)
+
+    async def _load_many(self, api, group, batch):
+        multi_method, group_params, _, multi_param = self.rules[group[0]]
+        message = api._new_message(multi_method)
+        for name, value in zip(group_params, group[1:]):
+            if value is not None:
+                message['params'][name] = value
+        message['params'][multi_param] = list(batch)
+        self.requests += 1
+        self.items += len(batch)
+        try:
+            result = await api._fetch(message)
+        except Exception as exc:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(exc)
+            raise
+        except BaseException:
+            for future in batch.values():
+                future.cancel()
+            raise
+        for item, future in batch.items():
+            if not future.done():
+                future.set_result(_lookup(result, item))
+
+
+# Subscriptions #
+_CLOSED = object()
+
+
+class Subscription(_Stream):
+    """
+    Stream of events pushed by the server for one monitor_event call, usable with for and async for.
+    Events wait in a bounded queue; when it is full, overflow decides whether the oldest event is dropped
+    ('drop_oldest'), the new event is dropped ('drop_newest') or the connection waits for the consumer ('block').
+    A dropping subscription stays on a pooled connection shared with other requests and subscriptions, whose reader
+    never waits for it. A blocking subscription gets a connection of its own, so only its own events are held up.
+    Either is renewed on a new connection when its connection drops.
+    """
+    OVERFLOW = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, api, message, max_queue=1024, overflow='drop_oldest', max_delay=30.0):
+        """
+        :param api: Instance the subscription is made through.
+        :param message: The monitorEvent message, before it is signed.
+        :param max_queue: Maximum number of undelivered events.
+        :param overflow: Policy used when the queue is full, one of OVERFLOW.
+        :param max_delay: Maximum number of seconds between attempts to renew a dropped subscription.
+        """
+        if overflow not in self.OVERFLOW:
+            raise ValueError("overflow must be one of {}".format(", ".join(self.OVERFLOW)))
+        self.api = api
+        self.method = message['method']
+        self.params = dict(message['params'])
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.max_delay = max_delay
+        self.result = None
+        self.dropped = 0
+        self.renewed = 0
+        self.closed = False
+        # The queue itself is unbounded, so ending the stream never waits for room; max_queue is applied by push.
+        self._queue = asyncio.Queue()
+        self._room = asyncio.Event()
+        self._connection = None
+        self._id = None
+        self._task = None
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is _CLOSED:
+            self._queue.put_nowait(_CLOSED)
+            raise StopAsyncIteration
+        self._room.set()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def push(self, frame):
+        if self.closed:
+            return
+        try:
+            item = self.api._parse(frame)
+        except Exception as exc:
+            item = exc
+        while self._queue.qsize() >= self.max_queue and self.overflow == 'block':
+            # Only the reader of the connection of this subscription waits here.
+            self._room.clear()
+            await self._room.wait()
+            if self.closed:
+                return
+        if self._queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            if self.overflow == 'drop_newest':
+                return
+            self._queue.get_nowait()
+        self._queue.put_nowait(item)
+
+    async def _subscribe(self):
+        message = self.api._new_message(self.method)
+        message['params'].update(self.params)
+        pool = self.api.pool if self.api.router is None else self.api.router.primary
+        connection = await (pool._handshake() if self.overflow == 'block' else pool._acquire())
+        connection.subscriptions[message['id']] = self
+        try:
+            future = await connection.send(message['id'], self.api._encode(message))
+            self.result = self.api._parse(await connection.wait(message['id'], future))
+        except BaseException:
+            connection.subscriptions.pop(message['id'], None)
+            if self.overflow == 'block':
+                await connection.close()
+            raise
+        self._connection, self._id = connection, message['id']
+
+    async def _start(self):
+        await self._subscribe()
+        self._task = asyncio.ensure_future(self._renew())
+        return self
+
+    async def _renew(self):
+        while not self.closed:
+            await self._connection.wait_closed()
+            self._connection.subscriptions.pop(self._id, None)
+            delay = 0.5
+            while not self.closed:
+                try:
+                    await self._subscribe()
+                    self.renewed += 1
+                    break
+                except ApiError as exc:
+                    self._finish(exc)
+                    return
+                except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_delay)
+
+    def _finish(self, error=None):
+        self.closed = True
+        if self._connection is not None:
+            self._connection.subscriptions.pop(self._id, None)
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        if error is not None:
+            self._queue.put_nowait(error)
+        self._queue.put_nowait(_CLOSED)
+        self._room.set()
+
+    async def aclose(self):
+        """
+        Stop delivering events. Iteration ends once the events already queued are dropped.
+        """
+        if not self.closed:
+            self._finish()
+            if self._task is not None:
+                self._task.cancel()
+            if self.overflow == 'block' and self._connection is not None:
+                await self._connection.close()
+            self.api.subscriptions.discard(self)
+
+    def close(self):
+        """
+        Stop delivering events; the synchronous twin of aclose().
+        """
+        if not self.closed:
+            self.api._run(self.aclose())
+
+
+# Scanning #
+class ScanCheckpoint:
+    """
+    File holding the first block a scan has not finished yet, so an interrupted scan can resume there.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)['next_block']
+        except FileNotFoundError:
+            return None
+
+    def save(self, next_block):
+        temporary = "{}.tmp".format(self.path)
+        with open(temporary, 'w') as f:
+            json.dump({'next_block': next_block}, f)
+        os.replace(temporary, self.path)
+
+
+class _RangeScanner(_Stream):
+    """
+    Ordered stream of the items a block-range query returns over a large range, usable with for and async for.
+    The range is fetched in chunks, several at a time. A chunk that times out, is too large for a websocket message
+    or is rejected by the server for returning too many results is split in half and later chunks shrink; other
+    errors are raised at once. Chunks with few items double the chunk size. Items are yielded in block order; with a checkpoint, the start of the first unfinished chunk is saved after
+    each chunk, so a restarted scan repeats at most the items of one chunk.
+    """
+    overlap = 0
+    # Error responses meaning the chunk returned too many results, as opposed to a bad query.
+    TOO_LARGE = re.compile(r'too (?:large|many|big)|more than|exceed|response size', re.IGNORECASE)
+
+    def __init__(self, api, from_block=0, to_block=None, chain_type='WAN', chunk_size=5000, workers=4, min_chunk=1,
+                 max_chunk=500000, sparse=100, timeout=30.0, checkpoint=None):
+        """
+        :param api: Instance the requests are made through.
+        :param from_block: First block of the range.
+        :param to_block: Last block of the range; by default the block number when the scan starts.
+        :param chain_type: The chain being queried.
+        :param chunk_size: Initial number of blocks per request.
+        :param workers: Maximum number of chunks requested at the same time.
+        :param min_chunk: Chunk size below which failures are raised instead of split.
+        :param max_chunk: Largest chunk size the scanner grows to.
+        :param sparse: Chunks returning fewer items than this grow the chunk size.
+        :param timeout: Seconds to wait for one chunk.
+        :param checkpoint: Optional ScanCheckpoint, or a path for one.
+        """
+        if isinstance(checkpoint, str):
+            checkpoint = ScanCheckpoint(checkpoint)
+        self.api = api
+        self.from_block = from_block
+        self.to_block = to_block
+        self.chain_type = chain_type
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.sparse = sparse
+        self.timeout = timeout
+        self.checkpoint = checkpoint
+        self.next_block = None
+        self.requests = 0
+        self.splits = 0
+        self._items = None
+
+    async def __anext__(self):
+        if self._items is None:
+            self._items = self._scan()
+        return await self._items.__anext__()
+
+    def _message(self, start, end):
+        raise NotImplementedError
+
+    def _select(self, items, first, last):
+        return items
+
+    async def _chunk(self, start, end):
+        self.requests += 1
+        return await asyncio.wait_for(self.api._fetch(self._message(start, end)), self.timeout)
+
+    def _request(self, start, end):
+        task = asyncio.ensure_future(self._chunk(start, end))
+        task.add_done_callback(_retrieve)
+        return task, start, end
+
+    @classmethod
+    def _too_large(cls, exc):
+        if isinstance(exc, ApiError):
+            return cls.TOO_LARGE.search(str(exc)) is not None
+        return isinstance(exc, asyncio.TimeoutError) or _message_too_big(exc)
+
+    async def _scan(self):
+        start = self.from_block
+        if self.checkpoint is not None:
+            start = max(start, self.checkpoint.load() or start)
+        end = self.to_block
+        if end is None:
+            end = _to_int(await self.api._fetch(self.api._new_message("getBlockNumber", self.chain_type)))
+        self.next_block = start
+        chunks = collections.deque()
+        try:
+            while chunks or start <= end:
+                while start <= end and len(chunks) < self.workers:
+                    last = min(start + self.chunk_size - 1, end)
+                    chunks.append(self._request(max(self.next_block, start - self.overlap), last))
+                    start = last + 1
+                task, first, last = chunks[0]
+                try:
+                    items = await task
+                except Exception as exc:
+                    if not self._too_large(exc) or last - first + 1 <= self.min_chunk:
+                        raise
+                    # Split the failed chunk and shrink later ones; chunks already requested keep their size.
+                    self.splits += 1
+                    middle = (first + last) // 2
+                    self.chunk_size = max(self.min_chunk, min(self.chunk_size, (last - first + 1) // 2))
+                    chunks.popleft()
+                    chunks.appendleft(self._request(middle + 1 - self.overlap, last))
+                    chunks.appendleft(self._request(first, middle))
+                    continue
+                chunks.popleft()
+                items = items or ()
+                if len(items) < self.sparse:
+                    self.chunk_size = min(self.max_chunk, self.chunk_size * 2)
+                for item in self._select(items, first, last):
+                    yield item
+                self.next_block = last + 1
+                if self.checkpoint is not None:
+                    self.checkpoint.save(self.next_block)
+        finally:
+            for task, _, _ in chunks:
+                task.cancel()
+
+
+class LogScanner(_RangeScanner):
+    """
+    Ordered stream of the logs matched by get_sc_event over a block range; see _RangeScanner for how the range is
+    fetched.
+    """
+    def __init__(self, api, address, topics, from_block=0, to_block=None, chain_type='WAN', **options):
+        """
+        :param api: Instance the requests are made through.
+        :param address: The contract address.
+        :param topics: Topics passed to get_sc_event.
+        :param options: Range, chunking, concurrency and checkpoint options of _RangeScanner.
+        """
+        super().__init__(api, from_block, to_block, chain_type, **options)
+        self.address = address
+        self.topics = topics
+
+    def _message(self, start, end):
+        message = self.api._new_message("getScEvent", self.chain_type)
+        message['params']['address'] = self.address
+        message['params']['topics'] = self.topics
+        message['params']['fromBlock'] = start
+        message['params']['toBlock'] = end
+        return message
+
+
+class AddressHistory(_RangeScanner):
+    """
+    Lazy stream of the transactions of one address, fetched with get_trans_by_address_between_blocks in block
+    windows while the caller consumes earlier ones. Consecutive windows share their boundary block, and
+    transactions already yielded from it are skipped, so none is lost or repeated whether the server treats the end
+    block as inclusive or not. Only a few windows are held in memory at a time.
+    """
+    overlap = 1
+
+    def __init__(self, api, address, from_block=0, to_block=None, chain_type='WAN', window=10000, prefetch=1,
+                 **options):
+        """
+        :param api: Instance the requests are made through.
+        :param address: The account's address.
+        :param window: Initial number of blocks per request.
+        :param prefetch: Number of windows requested ahead of the one being consumed.
+        :param options: Range, chunking and checkpoint options of _RangeScanner.
+        """
+        super().__init__(api, from_block, to_block, chain_type, chunk_size=window, workers=prefetch + 1, **options)
+        self.address = address
+        self._boundary = set()
+
+    def _message(self, start, end):
+        message = self.api._new_message("getTransByAddressBetweenBlocks", self.chain_type)
+        message['params']['address'] = self.address
+        message['params']['startBlockNo'] = start
+        message['params']['endBlockNo'] = end
+        return message
+
+    @staticmethod
+    def _identity(transaction):
+        return transaction.get('hash') or json.dumps(transaction, sort_keys=True)
+
+    def _select(self, items, first, last):
+        seen, self._boundary = self._boundary, set()
+        for transaction in items:
+            identity = self._identity(transaction)
+            if identity in seen:
+                continue
+            if _to_int(transaction.get('blockNumber')) == last:
+                self._boundary.add(identity)
+            yield transaction
+
+
+# Following #
+BlockEvent = collections.namedtuple('BlockEvent', 'kind number hash block transactions')
+
+
+class BlockFollower(_Stream):
+    """
+    Stream of new blocks in chain order, usable with for and async for.
+    Blocks are fetched ahead of the consumer a few at a time and the head is polled only once the follower has
+    caught up. Each block yields a BlockEvent of kind 'block'. When a block does not extend the last one yielded,
+    the blocks that were replaced are yielded newest first as 'rollback' events down to the common ancestor, and
+    following resumes from there. Blocks at or below the highest stable block are final and never rolled back.
+    """
+    def __init__(self, api, from_block=None, chain_type='WAN', transactions=False, workers=4, poll_interval=5.0):
+        """
+        :param api: Instance the requests are made through.
+        :param from_block: First block to yield; by default the block number when following starts.
+        :param chain_type: The chain being followed.
+        :param transactions: Whether to fetch the transactions of each block with get_trans_by_block.
+        :param workers: Maximum number of blocks fetched ahead of the consumer.
+        :param poll_interval: Seconds to wait before polling the head again once caught up.
+        """
+        self.api = api
+        self.from_block = from_block
+        self.chain_type = chain_type
+        self.transactions = transactions
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.head = None
+        self.stable = None
+        self.rollbacks = 0
+        self._chain = collections.deque()
+        self._events = None
+
+    async def __anext__(self):
+        if self._events is None:
+            self._events = self._follow()
+        return await self._events.__anext__()
+
+    async def _query(self, method, **params):
+        message = self.api._new_message(method, self.chain_type)
+        message['params'].update(params)
+        return await self.api._resolve(message)
+
+    async def _poll(self):
+        head, stable = await asyncio.gather(self._query("getBlockNumber"), self._query("getMaxStableBlkNumber"))
+        self.head, self.stable = _to_int(head), _to_int(stable)
+
+    async def _block(self, number):
+        block = await self._query("getBlockByNumber", blockNumber=number)
+        transactions = None
+        if block is not None and self.transactions:
+            transactions = await self._query("getTransByBlock", blockHash=block['hash'])
+        return block, transactions
+
+    def _request(self, number):
+        task = asyncio.ensure_future(self._block(number))
+        task.add_done_callback(_retrieve)
+        return number, task
+
+    async def _rollback(self):
+        while self._chain:
+            number, block_hash = self._chain[-1]
+            if self.stable is not None and number <= self.stable:
+                return
+            block = await self._query("getBlockByNumber", blockNumber=number)
+            if block is not None and block['hash'] == block_hash:
+                return
+            self._chain.pop()
+            self.rollbacks += 1
+            yield BlockEvent('rollback', number, block_hash, None, None)
+
+    async def _follow(self):
+        await self._poll()
+        number = self.head if self.from_block is None else self.from_block
+        pending = collections.deque()
+        try:
+            while True:
+                if not pending and number > self.head:
+                    await asyncio.sleep(self.poll_interval)
+                    await self._poll()
+                    continue
+                while len(pending) < self.workers and number <= self.head:
+                    pending.append(self._request(number))
+                    number += 1
+                expected, task = pending.popleft()
+                block, transactions = await task
+                later = block is None
+                if block is None:
+                    # Not served yet; fetch it again after the next poll.
+                    number = expected
+                elif self._chain and block['parentHash'] != self._chain[-1][1]:
+                    number = expected
+                    # With nothing to roll back the block conflicts with a stable one, e.g. from a node lagging
+                    # behind; it is fetched again after the next poll rather than at once.
+                    later = True
+                    async for event in self._rollback():
+                        number = event.number
+                        later = False
+                        yield event
+                else:
+                    self._chain.append((expected, block['hash']))
+                    yield BlockEvent('block', expected, block['hash'], block, transactions)
+                    while len(self._chain) > 1 and self.stable is not None and self._chain[1][0] <= self.stable:
+                        self._chain.popleft()
+                    continue
+                for _, task in pending:
+                    task.cancel()
+                pending.clear()
+                if later:
+                    await asyncio.sleep(self.poll_interval)
+                    await self._poll()
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+
+# Confirmations #
+class ConfirmationTracker:
+    """
+    Waits for any number of transactions to be buried wait_blocks deep, following the chain once for all of them.
+    The transaction hashes of each new block are matched against the tracked ones, so the requests made depend on
+    the block rate rather than on the number of transactions. A receipt is fetched when a transaction is added, in
+    case it is already mined, and again when it reaches its depth. Transactions of blocks that are rolled back, or
+    whose receipt has gone, wait for a block again. Following stops while nothing is tracked.
+    Created by ApiInstance.track_confirmations.
+    """
+    def __init__(self, api, wait_blocks=1, chain_type='WAN', poll_interval=1.0):
+        """
+        :param api: Instance the requests are made through.
+        :param wait_blocks: Number of blocks, counting the one holding the transaction, it must be buried under.
+        :param chain_type: The chain the transactions were sent to.
+        :param poll_interval: Seconds between polls of the chain head.
+        """
+        self.api = api
+        self.wait_blocks = wait_blocks
+        self.chain_type = chain_type
+        self.poll_interval = poll_interval
+        self.height = None
+        self._waiters = {}
+        self._mined = {}
+        self._unchecked = set()
+        self._settling = set()
+        self._task = None
+        self._ready = None
+
+    def __len__(self):
+        return len(self._waiters)
+
+    def add(self, tx_hash, wait_blocks=None, callback=None):
+        """
+        Track one transaction.
+        :param tx_hash: Hash of the transaction.
+        :param wait_blocks: Depth required for this transaction; by default the depth of the tracker.
+        :param callback: Optional function called with the hash and the receipt once the transaction is confirmed.
+        :return: Returns a future resolved with the receipt: a concurrent.futures.Future with ApiInstance, an asyncio
+        future with AsyncApiInstance.
+        """
+        future = self.api._future()
+        if callback is not None:
+            future.add_done_callback(
+                lambda done: done.cancelled() or done.exception() or callback(tx_hash, done.result()))
+        depth = self.wait_blocks if wait_blocks is None else wait_blocks
+        self.api._spawn(self._add(str(tx_hash).lower(), depth, future))
+        return future
+
+    def add_many(self, tx_hashes, wait_blocks=None, callback=None):
+        """
+        Track several transactions.
+        :return: Returns a list with the future of each transaction, in order.
+        """
+        return [self.add(tx_hash, wait_blocks, callback) for tx_hash in tx_hashes]
+
+    def cancel(self):
+        """
+        Stop tracking, cancelling the futures of every transaction still waiting.
+        """
+        self.api._spawn(self._cancel())
+
+    async def _cancel(self):
+        waiters, self._waiters = self._waiters, {}
+        self._mined.clear()
+        self._unchecked.clear()
+        for waiting in waiters.values():
+            for _, future in waiting:
+                future.cancel()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _add(self, tx_hash, depth, future):
+        self._waiters.setdefault(tx_hash, []).append((depth, future))
+        if self._task is None:
+            self._ready = asyncio.Event()
+            self._task = asyncio.ensure_future(self._follow())
+            self._task.add_done_callback(_retrieve)
+        # Receipts are checked once the head is known, so a block mined in between is seen by the follower.
+        await self._ready.wait()
+        await self._check([tx_hash])
+        await self._settle([tx_hash])
+
+    async def _receipt(self, tx_hash):
+        message = self.api._new_message("getTransactionReceipt", self.chain_type)
+        message['params']['txHash'] = tx_hash
+        return await self.api._fetch(message)
+
+    async def _check(self, tx_hashes):
+        receipts = await asyncio.gather(*(self._receipt(tx_hash) for tx_hash in tx_hashes), return_exceptions=True)
+        for tx_hash, receipt in zip(tx_hashes, receipts):
+            if isinstance(receipt, Exception):
+                # Checked again on the next block.
+                self._unchecked.add(tx_hash)
+                continue
+            self._unchecked.discard(tx_hash)
+            if receipt is not None and tx_hash in self._waiters:
+                self._mined.setdefault(tx_hash, _to_int(receipt.get('blockNumber')))
+
+    def _depth(self, tx_hash):
+        return min((depth for depth, future in self._waiters.get(tx_hash, ()) if not future.done()), default=None)
+
+    async def _settle(self, tx_hashes):
+        due = [tx_hash for tx_hash in tx_hashes
+               if self._mined.get(tx_hash) is not None and tx_hash not in self._settling
+               and self._depth(tx_hash) is not None and self.height - self._mined[tx_hash] + 1 >= self._depth(tx_hash)]
+        self._settling.update(due)
+        try:
+            receipts = await asyncio.gather(*(self._receipt(tx_hash) for tx_hash in due), return_exceptions=True)
+        finally:
+            self._settling.difference_update(due)
+        for tx_hash, receipt in zip(due, receipts):
+            if isinstance(receipt, Exception) or tx_hash not in self._waiters:
+                continue
+            if receipt is None:
+                self._mined.pop(tx_hash, None)
+                continue
+            number = self._mined[tx_hash] = _to_int(receipt.get('blockNumber'))
+            confirmations = self.height - number + 1
+            waiting = []
+            for depth, future in self._waiters[tx_hash]:
+                if future.done():
+                    continue
+                if depth <= confirmations:
+                    future.set_result(receipt)
+                else:
+                    waiting.append((depth, future))
+            if waiting:
+                self._waiters[tx_hash] = waiting
+            else:
+                del self._waiters[tx_hash]
+                self._mined.pop(tx_hash, None)
+
+    def _prune(self):
+        for tx_hash in [tx_hash for tx_hash in self._waiters if self._depth(tx_hash) is None]:
+            del self._waiters[tx_hash]
+            self._mined.pop(tx_hash, None)
+            self._unchecked.discard(tx_hash)
+
+    async def _follow(self):
+        try:
+            while self._waiters:
+                start = None if self.height is None else self.height + 1
+                follower = BlockFollower(self.api, start, self.chain_type, poll_interval=self.poll_interval)
+                try:
+                    async for event in follower:
+                        if event.kind == 'rollback':
+                            for tx_hash in [h for h, number in self._mined.items() if number == event.number]:
+                                del self._mined[tx_hash]
+                            self.height = event.number - 1
+                            continue
+                        self.height = event.number
+                        for transaction in event.block.get('transactions') or ():
+                            tx_hash = transaction['hash'] if isinstance(transaction, dict) else transaction
+                            if tx_hash.lower() in self._waiters:
+                                self._mined[tx_hash.lower()] = event.number
+                        self._ready.set()
+                        if follower.head is not None and event.number < follower.head:
+                            # Still catching up; settle once at the head.
+                            continue
+                        if self._unchecked:
+                            await self._check(list(self._unchecked))
+                        await self._settle(list(self._mined))
+                        self._prune()
+                        if not self._waiters:
+                            return
+                except (ApiError, OSError, asyncio.TimeoutError, websockets.WebSocketException):
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            self._task = None
+
+
+# Broadcasting #
+class _Sender:
+    __slots__ = ('nonce', 'floor', 'generation', 'lock')
+
+    def __init__(self):
+        self.nonce = None
+        # Lowest nonce the next resync may start from, or None.
+        self.floor = None
+        # Counts resyncs, so a failure of a nonce handed out before the last resync does not resync again.
+        self.generation = 0
+        self.lock = asyncio.Lock()
+
+
+class NonceManager:
+    """
+    Hands out the nonces of sender accounts locally. The first nonce of an account is the one returned by
+    get_nonce_include_pending; later ones are counted up without a round trip. resync() drops the count, so the
+    next nonce is fetched from the server again, e.g. after a "nonce too low" error.
+    Nonces are handed out on the event loop of the instance, so threads and tasks never get the same one.
+    """
+    NONCE_ERRORS = ("nonce too low", "nonce too high", "nonce gap", "replacement transaction underpriced")
+    # Errors meaning the nonce is already taken, rather than ahead of the account.
+    TAKEN_ERRORS = ("nonce too low", "replacement transaction underpriced")
+
+    def __init__(self, api, chain_type='WAN'):
+        """
+        :param api: Instance the requests are made through.
+        :param chain_type: The chain the transactions are sent to.
+        """
+        self.api = api
+        self.chain_type = chain_type
+        self.resyncs = 0
+        self._senders = {}
+
+    def _sender(self, address):
+        address = str(address).lower()
+        sender = self._senders.get(address)
+        if sender is None:
+            sender = self._senders[address] = _Sender()
+        return address, sender
+
+    async def _acquire(self, address):
+        address, sender = self._sender(address)
+        if sender.nonce is None:
+            async with sender.lock:
+                if sender.nonce is None:
+                    message = self.api._new_message("getNonceIncludePending", self.chain_type)
+                    message['params']['address'] = address
+                    nonce = _to_int(await self.api._fetch(message))
+                    # Nonces handed out before a "nonce too low" may still be on their way to the server.
+                    sender.nonce = nonce if sender.floor is None else max(nonce, sender.floor)
+                    sender.floor = None
+        nonce = sender.nonce
+        sender.nonce += 1
+        return nonce
+
+    def next_nonce(self, address):
+        """
+        :param address: The sender account.
+        :return: Returns the next nonce of the account; with AsyncApiInstance it must be awaited.
+        """
+        return self.api._complete(self._acquire(address))
+
+    def _generation(self, address):
+        return self._sender(address)[1].generation
+
+    def _reset(self, address, generation=None, taken=False):
+        _, sender = self._sender(address)
+        if sender.nonce is not None and (generation is None or generation == sender.generation):
+            sender.floor = sender.nonce if taken else None
+            sender.nonce = None
+            sender.generation += 1
+            self.resyncs += 1
+
+    def _release(self, address, nonce, generation):
+        # A nonce that was never sent is given back while it is the last one handed out, so no gap is left behind.
+        _, sender = self._sender(address)
+        if generation == sender.generation and sender.nonce == nonce + 1:
+            sender.nonce = nonce
+        else:
+            self._reset(address, generation)
+
+    async def _resync(self, address):
+        self._reset(address)
+
+    def resync(self, address):
+        """
+        Fetch the nonce of an account from the server again the next time one is needed.
+        Runs on the event loop of the instance, like next_nonce(), so it never lands between reading and counting up
+        a nonce.
+        :param address: The sender account.
+        :return: Returns None; with AsyncApiInstance it must be awaited.
+        """
+        return self.api._complete(self._resync(address))
+
+    @classmethod
+    def is_nonce_error(cls, error):
+        """
+        :return: Returns whether an error response rejected a transaction because of its nonce.
+        """
+        text = str(error).lower()
+        return any(pattern in text for pattern in cls.NONCE_ERRORS)
+
+    @classmethod
+    def is_taken_error(cls, error):
+        """
+        :return: Returns whether an error response rejected a transaction because its nonce is already used.
+        """
+        text = str(error).lower()
+        return any(pattern in text for pattern in cls.TAKEN_ERRORS)
+
+
+class BroadcastPipeline:
+    """
+    Sends signed transactions of many senders concurrently, numbering each sender's transactions with a
+    NonceManager. Transactions of one sender get their nonces and are sent in submission order, up to window of them
+    in flight at once. A transaction rejected because of its nonce is signed again with a fresh nonce and resent,
+    at most retries times; any other rejection resyncs the sender's nonce, since the rejected one was not used.
+    After a nonce that is already taken, counting resumes from the server's nonce or the local count, whichever is
+    higher, so nonces of transactions still on their way are not handed out twice.
+    Created by ApiInstance.broadcast_pipeline.
+    """
+    def __init__(self, api, chain_type='WAN', window=32, retries=3, nonces=None):
+        """
+        :param api: Instance the requests are made through.
+        :param chain_type: The chain the transactions are sent to.
+        :param window: Maximum number of transactions of one sender in flight.
+        :param retries: Number of times a transaction rejected because of its nonce is signed and sent again.
+        :param nonces: NonceManager to number transactions with; by default a new one.
+        """
+        self.api = api
+        self.chain_type = chain_type
+        self.window = window
+        self.retries = retries
+        self.nonces = nonces if nonces is not None else NonceManager(api, chain_type)
+        self.sent = 0
+        self.failed = 0
+        self._queues = {}
+        self._windows = {}
+
+    def submit(self, sender, sign):
+        """
+        Queue one transaction.
+        :param sender: The account sending the transaction.
+        :param sign: Function returning the signed transaction for a given nonce; it is called on the event loop
+        of the instance, once per attempt.
+        :return: Returns a future resolved with the transaction hash: a concurrent.futures.Future with ApiInstance,
+        an asyncio future with AsyncApiInstance.
+        """
+        future = self.api._future()
+        self.api._spawn(self._enqueue(sender, sign, future))
+        return future
+
+    async def _enqueue(self, address, sign, future):
+        address = str(address).lower()
+        queue = self._queues.get(address)
+        if queue is None:
+            # The first transaction of an idle sender starts the task draining its queue.
+            queue = self._queues[address] = collections.deque()
+            worker = asyncio.ensure_future(self._drain(address, queue))
+            worker.add_done_callback(_retrieve)
+        queue.append((sign, future))
+
+    async def _drain(self, address, queue):
+        window = self._windows.get(address)
+        if window is None:
+            window = self._windows[address] = asyncio.Semaphore(self.window)
+        try:
+            while queue:
+                sign, future = queue.popleft()
+                if future.done():
+                    continue
+                await window.acquire()
+                nonce = None
+                try:
+                    nonce = await self.nonces._acquire(address)
+                    generation = self.nonces._generation(address)
+                    signed_tx = sign(nonce)
+                except BaseException as exc:
+                    if nonce is not None:
+                        self.nonces._release(address, nonce, generation)
+                    window.release()
+                    if not future.done():
+                        future.set_exception(exc)
+                    if not isinstance(exc, Exception):
+                        raise
+                    continue
+                task = asyncio.ensure_future(self._send(address, sign, signed_tx, generation, future))
+                task.add_done_callback(lambda _: window.release())
+                # Let the send start before the next nonce is handed out, so writes follow nonce order.
+                await asyncio.sleep(0)
+        finally:
+            del self._queues[address]
+
+    async def _send(self, address, sign, signed_tx, generation, future):
+        attempt = 0
+        while True:
+            message = self.api._new_message("sendRawTransaction", self.chain_type)
+            message['params']['signedTx'] = signed_tx
+            try:
+                tx_hash = await self.api._fetch(message)
+            except Exception as exc:
+                # The transactions in flight with it fail the same way; only the first one resyncs.
+                self.nonces._reset(address, generation, isinstance(exc, ApiError) and self.nonces.is_taken_error(exc))
+                if isinstance(exc, ApiError) and self.nonces.is_nonce_error(exc) and attempt < self.retries:
+                    attempt += 1
+                    nonce = None
+                    try:
+                        nonce = await self.nonces._acquire(address)
+                        generation = self.nonces._generation(address)
+                        signed_tx = sign(nonce)
+                        continue
+                    except Exception as error:
+                        if nonce is not None:
+                            self.nonces._release(address, nonce, generation)
+                        exc = error
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(exc)
+                return
+            self.sent += 1
+            if not future.done():
+                future.set_result(tx_hash)
+            return
+
+
+# Contracts #
+class ContractMethod:
+    """
+    Prepared callScFunc, getScMap or getScVar request for one member of a Contract.
+    The constant params, including the ABI fragment of the member, are serialized once and spliced into every request.
+    """
+    def __init__(self, contract, method, name, param=None):
+        """
+        :param contract: The Contract the member belongs to.
+        :param method: Api method of the requests, e.g. "callScFunc".
+        :param name: Name of the contract function, map or variable.
+        :param param: Name of the request param taking the argument of a call, e.g. "args"; None if there is none.
+        """
+        self.contract = contract
+        self.method = method
+        self.name = name
+        self.param = param
+        fixed = {"chainType": contract.chain_type, "scAddr": contract.sc_addr, "name": name,
+                 "abi": contract.fragment(name)}
+        self._fixed = fixed
+        self._prepared = (_stdlib_dumps(fixed)[1:-1], frozenset(fixed))
+
+    def __repr__(self):
+        return "ContractMethod({!r}, {!r})".format(self.method, self.name)
+
+    def _message(self, value=None):
+        message = self.contract.api._new_message(self.method)
+        message['params'].update(self._fixed)
+        if self.param is not None:
+            message['params'][self.param] = value
+        message['prepared'] = self._prepared
+        return message
+
+    def __call__(self, *args):
+        """
+        :param args: The arguments of the function, or the key of the map; none for a variable.
+        :return: Returns result object from api response; with AsyncApiInstance it must be awaited.
+        """
+        if self.param == 'args':
+            return self.contract.api._call(self._message(list(args)))
+        return self.contract.api._call(self._message(*args))
+
+    def many(self, values):
+        """
+        Send one request per item concurrently.
+        :param values: Iterable of argument lists of the function, or of keys of the map.
+        :return: Returns a list with one result or exception per item, in order; with AsyncApiInstance it must be
+        awaited.
+        """
+        return self.contract.api._gather([self._message(list(value) if self.param == 'args' else value)
+                                          for value in values])
+
+
+class Contract:
+    """
+    Contract queried many times: each function, map or variable is prepared once, with only its own ABI entries.
+    """
+    def __init__(self, api, sc_addr, abi, chain_type='WAN'):
+        """
+        :param api: The ApiInstance sending the requests.
+        :param sc_addr: Address of the contract.
+        :param abi: The abi of the contract, as a list or as JSON text.
+        :param chain_type: The chain of the contract. Currently supports "WAN" or "ETH".
+        """
+        self.api = api
+        self.sc_addr = sc_addr
+        self.abi = json.loads(abi) if isinstance(abi, (str, bytes)) else list(abi)
+        self.chain_type = chain_type
+        self._methods = {}
+
+    def fragment(self, name):
+        """
+        :param name: Name of a contract function, or of a public map or variable.
+        :return: Returns the entries of the abi describing it, raising ValueError if there are none.
+        """
+        entries = [entry for entry in self.abi
+                   if entry.get('name') == name and entry.get('type', 'function') == 'function']
+        if not entries:
+            raise ValueError("no function {!r} in the abi of {}".format(name, self.sc_addr))
+        return entries
+
+    def _method(self, method, name, param):
+        prepared = self._methods.get((method, name))
+        if prepared is None:
+            prepared = self._methods[(method, name)] = ContractMethod(self, method, name, param)
+        return prepared
+
+    def function(self, name):
+        """
+        :param name: Name of a public function of the contract.
+        :return: Returns a ContractMethod calling it with callScFunc, e.g. contract.function("balanceOf")(address).
+        """
+        return self._method("callScFunc", name, 'args')
+
+    def map(self, name):
+        """
+        :param name: Name of a public map of the contract.
+        :return: Returns a ContractMethod reading it with getScMap, e.g. contract.map("balances")(address).
+        """
+        return self._method("getScMap", name, 'key')
+
+    def var(self, name):
+        """
+        :param name: Name of a public variable of the contract.
+        :return: Returns a ContractMethod reading it with getScVar, e.g. contract.var("totalSupply")().
+        """
+        return self._method("getScVar", name, None)
+
+
+# Models #
+_model_loads = JsonCodec.find().loads
+
+
+class _Field:
+    """
+    Attribute of a model read from one key of its payload, decoded on first access and memoized.
+    """
+    def __init__(self, key, decode=None):
+        self.key = key
+        self.decode = decode
+        self.name = None
+        self.index = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        values = instance._values
+        if values is None:
+            data = instance.as_dict()
+            values = instance._values = [data.get(field.key) for field in owner._fields]
+        mask = 1 << self.index
+        if not instance._decoded & mask:
+            value = values[self.index]
+            if value is not None and self.decode is not None:
+                values[self.index] = self.decode(value)
+            instance._decoded |= mask
+        return values[self.index]
+
+
+def _list_of(model):
+    return lambda items: [model(item) if isinstance(item, dict) else item for item in items]
+
+
+class _Model:
+    """
+    Typed view of one result object.
+    The payload is kept as given, either a dict or the compact JSON of the object, and fields are decoded only when
+    read. Keys without a field are still reachable with model[key].
+    """
+    __slots__ = ('payload', '_values', '_decoded')
+    _fields = ()
+
+    def __init__(self, payload):
+        """
+        :param payload: The result object, as a dict or as JSON str or bytes.
+        """
+        self.payload = payload
+        self._values = None
+        self._decoded = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = [value for value in vars(cls).values() if isinstance(value, _Field)]
+        for index, field in enumerate(cls._fields):
+            field.index = index
+
+    def as_dict(self):
+        """
+        :return: Returns the payload as a dict; a JSON payload is parsed on each call.
+        """
+        if isinstance(self.payload, dict):
+            return self.payload
+        return _model_loads(self.payload)
+
+    def __getitem__(self, key):
+        return self.as_dict()[key]
+
+    def get(self, key, default=None):
+        return self.as_dict().get(key, default)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.as_dict() == other.as_dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        field = self._fields[0]
+        return "{}({}={!r})".format(type(self).__name__, field.name, getattr(self, field.name))
+
+
+class Log(_Model):
+    __slots__ = ()
+    log_index = _Field('logIndex', _to_int)
+    address = _Field('address')
+    topics = _Field('topics')
+    data = _Field('data')
+    block_number = _Field('blockNumber', _to_int)
+    block_hash = _Field('blockHash')
+    transaction_hash = _Field('transactionHash')
+    transaction_index = _Field('transactionIndex', _to_int)
+    removed = _Field('removed')
+
+
+class Transaction(_Model):
+    __slots__ = ()
+    hash = _Field('hash')
+    nonce = _Field('nonce', _to_int)
+    block_hash = _Field('blockHash')
+    block_number = _Field('blockNumber', _to_int)
+    transaction_index = _Field('transactionIndex', _to_int)
+    from_ = _Field('from')
+    to = _Field('to')
+    value = _Field('value', _to_int)
+    gas = _Field('gas', _to_int)
+    gas_price = _Field('gasPrice', _to_int)
+    input = _Field('input')
+
+
+class Receipt(_Model):
+    __slots__ = ()
+    transaction_hash = _Field('transactionHash')
+    transaction_index = _Field('transactionIndex', _to_int)
+    block_hash = _Field('blockHash')
+    block_number = _Field('blockNumber', _to_int)
+    from_ = _Field('from')
+    to = _Field('to')
+    contract_address = _Field('contractAddress')
+    cumulative_gas_used = _Field('cumulativeGasUsed', _to_int)
+    gas_used = _Field('gasUsed', _to_int)
+    status = _Field('status', _to_int)
+    logs = _Field('logs', _list_of(Log))
+    logs_bloom = _Field('logsBloom')
+
+
+class Block(_Model):
+    __slots__ = ()
+    number = _Field('number', _to_int)
+    hash = _Field('hash')
+    parent_hash = _Field('parentHash')
+    timestamp = _Field('timestamp', _to_int)
+    miner = _Field('miner')
+    difficulty = _Field('difficulty', _to_int)
+    total_difficulty = _Field('totalDifficulty', _to_int)
+    size = _Field('size', _to_int)
+    gas_limit = _Field('gasLimit', _to_int)
+    gas_used = _Field('gasUsed', _to_int)
+    nonce = _Field('nonce')
+    extra_data = _Field('extraData')
+    state_root = _Field('stateRoot')
+    transactions_root = _Field('transactionsRoot')
+    receipts_root = _Field('receiptsRoot')
+    logs_bloom = _Field('logsBloom')
+    transactions = _Field('transactions', _list_of(Transaction))
+    uncles = _Field('uncles')
+
+
+class StakerInfo(_Model):
+    __slots__ = ()
+    address = _Field('address')
+    pub_sec256 = _Field('pubSec256')
+    pub_bn256 = _Field('pubBn256')
+    amount = _Field('amount', _to_int)
+    voting_power = _Field('votingPower', _to_int)
+    lock_epochs = _Field('lockEpochs', _to_int)
+    next_lock_epochs = _Field('nextLockEpochs', _to_int)
+    from_ = _Field('from')
+    staking_epoch = _Field('stakingEpoch', _to_int)
+    fee_rate = _Field('feeRate', _to_int)
+    max_fee_rate = _Field('maxFeeRate', _to_int)
+    fee_rate_changed_epoch = _Field('feeRateChangedEpoch', _to_int)
+    clients = _Field('clients')
+    partners = _Field('partners')
+
+
+# Model of the result of each typed method, or of each item when the result is a list.
+MODELS = {
+    "getBlockByNumber": Block,
+    "getBlockByHash": Block,
+    "getTxInfo": Transaction,
+    "getTransByBlock": Transaction,
+    "getTransByAddress": Transaction,
+    "getTransByAddressBetweenBlocks": Transaction,
+    "getTransactionReceipt": Receipt,
+    "getScEvent": Log,
+    "getCurrentStakerInfo": StakerInfo,
+}
+
+
+# POS clock #
+class PosClock:
+    """
+    Epoch and slot ids of a POS chain computed from the local time.
+    Slot time, slot count and POS info are fetched once. The offset between the server's slot count and the local
+    one, normally zero, is measured on creation and again every resync_interval seconds in the background; drifts
+    counts the resyncs that found it changed. Created by ApiInstance.pos_clock.
+    """
+    def __init__(self, api, chain_type='WAN', resync_interval=600.0):
+        """
+        :param api: ApiInstance used to query the chain.
+        :param chain_type: The chain of the clock. Currently supports 'WAN'.
+        :param resync_interval: Seconds after which the offset is measured again.
+        """
+        self.api = api
+        self.chain_type = chain_type
+        self.resync_interval = resync_interval
+        self.slot_time = None
+        self.slot_count = None
+        self.pos_info = None
+        self.offset = 0
+        self.synced_at = None
+        self.drifts = 0
+        self._resyncing = False
+
+    async def _query(self, method):
+        return await self.api._fetch(self.api._new_message(method, self.chain_type))
+
+    async def _start(self):
+        self.slot_time, self.slot_count, self.pos_info = await asyncio.gather(
+            self._query("getSlotTime"), self._query("getSlotCount"), self._query("getPosInfo"))
+        self.slot_time, self.slot_count = _to_int(self.slot_time), _to_int(self.slot_count)
+        if not self.slot_time or not self.slot_count:
+            raise ValueError("invalid slot time {!r} or slot count {!r}".format(self.slot_time, self.slot_count))
+        await self._sync()
+        return self
+
+    async def _sync(self):
+        for _ in range(3):
+            before = time.time()
+            epoch_id, slot_id = await asyncio.gather(self._query("getEpochID"), self._query("getSlotID"))
+            after = time.time()
+            # The server read its clock somewhere between the two local readings; it is unambiguous only if
+            # both fall in the same slot.
+            if int(before // self.slot_time) == int(after // self.slot_time):
+                break
+        offset = _to_int(epoch_id) * self.slot_count + _to_int(slot_id) - int(after // self.slot_time)
+        if self.synced_at is not None and offset != self.offset:
+            self.drifts += 1
+        self.offset = offset
+        self.synced_at = time.monotonic()
+
+    async def _resync(self):
+        try:
+            await self._sync()
+        except (ApiError, OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            # Keep the current offset and try again after a tenth of the interval.
+            self.synced_at = time.monotonic() - self.resync_interval * 0.9
+        finally:
+            self._resyncing = False
+
+    def _slot_index(self, at):
+        # A clock of a closed instance keeps its last offset.
+        if not self._resyncing and not self.api.closed and time.monotonic() - self.synced_at > self.resync_interval:
+            self._resyncing = True
+            self.api._spawn(self._resync())
+        return int((time.time() if at is None else at) // self.slot_time) + self.offset
+
+    def epoch_id(self, at=None):
+        """
+        :param at: UTC time in seconds; by default now.
+        :return: Returns the epoch ID at that time.
+        """
+        return self._slot_index(at) // self.slot_count
+
+    def slot_id(self, at=None):
+        """
+        :param at: UTC time in seconds; by default now.
+        :return: Returns the slot ID within its epoch at that time.
+        """
+        return self._slot_index(at) % self.slot_count
+
+    def epoch_id_by_time(self, query_time):
+        """
+        Local counterpart of ApiInstance.get_epoch_id_by_time.
+        :param query_time: UTC time in seconds.
+        :return: Returns the epoch ID at that time.
+        """
+        return self.epoch_id(query_time)
+
+    def time_by_epoch_id(self, epoch_id):
+        """
+        Local counterpart of ApiInstance.get_time_by_epoch_id.
+        :param epoch_id: The epoch ID.
+        :return: Returns the start time of the epoch in UTC seconds.
+        """
+        return (int(epoch_id) * self.slot_count - self.offset) * self.slot_time
+
+
 class ApiInstance:
-    def __init__(self, api_key, secret_key, uri='wss://api.wanchain.org:8443/ws/v3/'):
+    def __init__(self, api_key, secret_key, uri='wss://api.wanchain.org:8443/ws/v3/', pool_size=4,
+                 pos_cache=None, block_cache=None, ttl_cache=None, token_cache=None, coalescer=None,
+                 rate_limiter=None, policy=None, codec=None, metrics=None, max_message_size=2 ** 26):
+        """
+        :param api_key: Api key of the iWan account.
+        :param secret_key: Secret key used to sign requests.
+        :param uri: Websocket url of the iWan server, or a list of urls of equivalent servers, the primary first.
+        Requests are then routed by an EndpointRouter.
+        :param pool_size: Maximum number of connections kept open to each server.
+        :param pos_cache: Optional PosHistoryCache used for POS queries about past epochs.
+        :param block_cache: Optional FinalityCache used for stable blocks, transactions and receipts.
+        :param ttl_cache: Optional TtlCache used for hot, fast-changing values.
+        :param token_cache: Optional TokenInfoCache used for token metadata.
+        :param coalescer: Optional Coalescer merging concurrent single-item calls into their multi-item variants.
+        :param rate_limiter: Optional RateLimiter applied to every request sent, e.g. RateLimiter.for_key(api_key).
+        :param policy: CallPolicy with the default deadline, retries and hedging; by default CallPolicy().
+        :param codec: JsonCodec used for responses; by default the fastest one installed.
+        :param metrics: Optional Metrics receiving timings, sizes and errors of every request.
+        :param max_message_size: Largest reply accepted, in bytes, or None for no limit; by default 64 MiB, enough for
+        staker lists and other large results.
+        """
         self.api_key = str(api_key)
         self.secret_key = str(secret_key)
-        self.uri = str(uri)
-        if self.uri[-1] != "/":
-            self.uri += "/"
+        uris = [str(uri)] if isinstance(uri, str) else [str(item) for item in uri]
+        uris = [item if item[-1] == "/" else item + "/" for item in uris]
+        self.uri = uris[0]
         self.endpoint = "{}{}".format(self.uri, self.api_key)
+        if len(uris) > 1:
+            self.router = EndpointRouter(["{}{}".format(item, self.api_key) for item in uris], size=pool_size,
+                                         max_size=max_message_size)
+            self.pool = self.router.pools[0]
+        else:
+            self.router = None
+            self.pool = ConnectionPool(self.endpoint, size=pool_size, max_size=max_message_size)
+        self.pos_cache = pos_cache
+        self.block_cache = block_cache
+        self.ttl_cache = ttl_cache
+        self.token_cache = token_cache
+        self.caches = [cache for cache in (pos_cache, block_cache, ttl_cache, token_cache) if cache is not None]
+        self.coalescer = coalescer
+        self.rate_limiter = rate_limiter
+        self.policy = policy if policy is not None else CallPolicy()
+        self.codec = codec if codec is not None else JsonCodec.find()
+        self.metrics = metrics
+        if metrics is not None:
+            for pool in (self.router.pools if self.router is not None else [self.pool]):
+                metrics.track(pool)
+        self.subscriptions = set()
+        self.hedged = 0
+        self.retried = 0
+        self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=256))
+        self._inflight = {}
+        self._ids = itertools.count(1)
+        self._templates = {}
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.closed = False
+
+    @property
+    def secret_key(self):
+        return self._secret_key
+
+    @secret_key.setter
+    def secret_key(self, value):
+        self._secret_key = str(value)
+        self._hmac = hmac.new(bytes(self._secret_key, 'utf-8'), digestmod=hashlib.sha256)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close pooled connections and stop the event loop thread used by this instance. The instance can not be used
+        afterwards: its connections and other state belong to the stopped loop.
+        """
+        with self._lock:
+            self.closed = True
+        if self._loop is None:
+            return
+        # Not through _run, whose wrapper task would be cancelled along with every other task.
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        with self._lock:
+            loop, thread, self._loop, self._thread = self._loop, self._thread, None, None
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    @contextlib.contextmanager
+    def options(self, **changes):
+        """
+        Change the call policy of this instance for the calls made inside a with block, e.g.
+        with api.options(timeout=2.0, retries=0): api.get_balance(address)
+        :param changes: CallPolicy settings to change.
+        """
+        token = _POLICY.set((self, self.policy.replace(**changes)))
+        try:
+            yield self
+        finally:
+            _POLICY.reset(token)
+
+    async def _shutdown(self):
+        for subscription in list(self.subscriptions):
+            await subscription.aclose()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await (self.pool if self.router is None else self.router).close()
 
     # Utility methods #
+    def _start_loop(self):
+        # Calls from any thread run on one event loop owned by the instance, sharing its connections.
+        with self._lock:
+            if self.closed:
+                raise RuntimeError("ApiInstance is closed")
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="iwan-loop", daemon=True)
+                thread.start()
+                self._loop, self._thread = loop, thread
+            return self._loop
+
+    def _run(self, coroutine):
+        try:
+            loop = self._loop or self._start_loop()
+        except RuntimeError:
+            coroutine.close()
+            raise
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError("ApiInstance can not be called from its own event loop; use AsyncApiInstance there")
+        future = asyncio.run_coroutine_threadsafe(_within(contextvars.copy_context(), coroutine), loop)
+        try:
+            return future.result()
+        except BaseException:
+            # Interrupted while waiting, e.g. by KeyboardInterrupt: do not leave the call running.
+            future.cancel()
+            raise
+
+    def _future(self):
+        return concurrent.futures.Future()
+
+    def _complete(self, coroutine):
+        return self._run(coroutine)
+
+    def _spawn(self, coroutine):
+        try:
+            loop = self._loop or self._start_loop()
+        except RuntimeError:
+            coroutine.close()
+            raise
+        asyncio.run_coroutine_threadsafe(_within(contextvars.copy_context(), coroutine), loop)
+
     def _new_message(self, method, chain_type=None):
         if chain_type is not None:
-            obj = {"jsonrpc": "2.0", "method": str(method), "params": {"chainType": chain_type}, "id": 1}
+            obj = {"jsonrpc": "2.0", "method": str(method), "params": {"chainType": chain_type}, "id": next(self._ids)}
         else:
-            obj = {"jsonrpc": "2.0", "method": str(method), "params": {}, "id": 1}
+            obj = {"jsonrpc": "2.0", "method": str(method), "params": {}, "id": next(self._ids)}
         return obj
 
-    def _make_signature(self, message):
-        json_message = bytes(json.dumps(message, separators=(',', ':')), 'utf-8')
-        auth_code = hmac.new(bytes(self.secret_key, 'utf-8'), msg=json_message, digestmod=hashlib.sha256)
+    def _sign(self, data):
+        auth_code = self._hmac.copy()
+        auth_code.update(data)
         return base64.b64encode(auth_code.digest()).decode()
 
+    def _make_signature(self, message):
+        return self._sign(bytes(json.dumps(message, separators=(',', ':')), 'utf-8'))
+
+    def _template(self, method):
+        template = self._templates.get(method)
+        if template is None:
+            template = self._templates[method] = '{{"jsonrpc":"2.0","method":{},"params":'.format(json.dumps(method))
+        return template
+
+    def _encode(self, message):
+        # Serializes params once: the signed text is the message without the signature, and the wire text is the
+        # same string with the signature spliced in as the last params member.
+        params = message['params']
+        params['timestamp'] = timestamp()
+        head = self._template(message['method'])
+        prepared = message.get('prepared')
+        if prepared is None:
+            body = _stdlib_dumps(params)
+        else:
+            # Params serialized in advance, e.g. a contract ABI, come first; the timestamp keeps the rest non-empty.
+            text, names = prepared
+            body = '{{{},{}'.format(text, _stdlib_dumps({name: value for name, value in params.items()
+                                                        if name not in names})[1:])
+        tail = ',"id":{}}}'.format(_stdlib_dumps(message['id']))
+        if self.metrics is None:
+            signature = self._sign((head + body + tail).encode())
+        else:
+            started = time.perf_counter()
+            signature = self._sign((head + body + tail).encode())
+            sign_time = time.perf_counter() - started
+        params['signature'] = signature
+        payload = '{}{},"signature":"{}"}}{}'.format(head, body[:-1], signature, tail)
+        if self.metrics is not None:
+            self.metrics.on_request(message['method'], message['id'], len(payload), sign_time)
+        return payload
+
+    def _parse(self, frame, raw=False):
+        if raw:
+            match = _RESULT.match(frame) if isinstance(frame, str) else None
+            if match is not None:
+                # The server writes the result last, so it spans up to the closing brace of the response.
+                return frame[match.end():frame.rindex('}')].rstrip().encode()
+            return self.codec.dumps(self._parse(frame)).encode()
+        response = self.codec.loads(frame)
+        if 'result' not in response and 'error' in response:
+            raise ApiError(response['error'])
+        return response['result']
+
+    def _typed(self, message, result):
+        model = MODELS.get(message['method'])
+        if model is None or result is None:
+            return result
+        # Models keep compact JSON rather than the parsed dicts, which take several times the memory.
+        if isinstance(result, list):
+            return [model(self.codec.dumps(item).encode()) for item in result]
+        return model(self.codec.dumps(result).encode())
+
+    def _policy(self):
+        instance, policy = _POLICY.get()
+        return policy if instance is self else self.policy
+
+    def _cached(self, message):
+        keys = []
+        for cache in self.caches:
+            key = cache.key(message)
+            if key is not None:
+                value = cache.get(key)
+                if value is not _MISSING:
+                    if cache.revalidate(key):
+                        self._spawn(self._dispatch(message, [(cache, key)]))
+                    return None, value
+                keys.append((cache, key))
+        return keys, _MISSING
+
+    async def _send(self, message, timeout=None):
+        # The attempt timeout is applied here, below the rate limiter, metrics and router, so that all of them see
+        # an attempt running out of time as a failure rather than as a cancelled request.
+        if self.router is None:
+            if timeout is None:
+                return await self.pool.request(message['id'], self._encode(message))
+            return await asyncio.wait_for(self.pool.request(message['id'], self._encode(message)), timeout)
+        return await self.router.request(message['id'], self._encode(message),
+                                         message['method'] in CallPolicy.NON_IDEMPOTENT, timeout)
+
+    async def _fetch(self, message, raw=False):
+        if not raw and self.coalescer is not None and message['method'] in self.coalescer.rules:
+            result = await self.coalescer.load(self, message)
+            if result is not _MISSING:
+                return result
+        policy = self._policy()
+        if policy.timeout is None:
+            return await self._attempts(message, policy, raw)
+        return await asyncio.wait_for(self._attempts(message, policy, raw), policy.timeout)
+
+    def _renew(self, message):
+        renewed = self._new_message(message['method'])
+        renewed['params'] = {name: value for name, value in message['params'].items()
+                             if name not in ('timestamp', 'signature')}
+        if 'prepared' in message:
+            renewed['prepared'] = message['prepared']
+        return renewed
+
+    async def _attempts(self, message, policy, raw=False):
+        retries = 0 if message['method'] in policy.NON_IDEMPOTENT else policy.retries
+        attempt = 0
+        while True:
+            try:
+                if message['method'] in policy.hedge:
+                    return await self._hedged(message, policy, raw)
+                return await self._attempt(message, raw, policy.attempt_timeout)
+            except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as exc:
+                if attempt >= retries or _message_too_big(exc):
+                    raise
+            await asyncio.sleep(policy.delay(attempt))
+            attempt += 1
+            self.retried += 1
+            message = self._renew(message)
+
+    async def _hedged(self, message, policy, raw=False):
+        latencies = self._latencies[message['method']]
+        first = asyncio.ensure_future(self._attempt(message, raw, policy.attempt_timeout))
+        first.add_done_callback(_retrieve)
+        if len(latencies) < policy.hedge_min_samples:
+            return await first
+        threshold = sorted(latencies)[min(len(latencies) - 1, int(len(latencies) * policy.hedge_percentile))]
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=threshold)
+            if not done:
+                self.hedged += 1
+                second = asyncio.ensure_future(self._attempt(self._renew(message), raw, policy.attempt_timeout))
+                second.add_done_callback(_retrieve)
+                tasks.append(second)
+            pending = list(tasks)
+            while True:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.remove(task)
+                    if task.exception() is None or not pending:
+                        return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _attempt(self, message, raw=False, timeout=None):
+        started = time.monotonic()
+        if self.rate_limiter is None and self.metrics is None:
+            result = self._parse(await self._send(message, timeout), raw)
+        else:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+            ok = None
+            try:
+                result = await self._measured(message, raw, started, timeout)
+                ok = True
+            except (ApiError, OSError, asyncio.TimeoutError, websockets.WebSocketException) as exc:
+                ok = False
+                if self.metrics is not None:
+                    self.metrics.on_error(message['method'], message['id'], time.monotonic() - started, exc)
+                raise
+            finally:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.release(ok)
+        self._latencies[message['method']].append(time.monotonic() - started)
+        return result
+
+    async def _measured(self, message, raw, started, timeout=None):
+        frame = await self._send(message, timeout)
+        if self.metrics is None:
+            return self._parse(frame, raw)
+        parsing = time.perf_counter()
+        result = self._parse(frame, raw)
+        parse_time = time.perf_counter() - parsing
+        self.metrics.on_response(message['method'], message['id'], time.monotonic() - started, len(frame), parse_time)
+        return result
+
+    async def _fill(self, message, keys):
+        try:
+            result = await self._fetch(message)
+        finally:
+            del self._inflight[keys[0][1]]
+        # Deciding whether to store a result may take another request, which the caller does not wait for. The text
+        # is taken now, before the caller can change the result.
+        admission = asyncio.ensure_future(self._admit(message, keys, result, json.dumps(result, separators=(',', ':'))))
+        admission.add_done_callback(_retrieve)
+        return result
+
+    async def _admit(self, message, keys, result, text):
+        for cache, key in keys:
+            try:
+                if await cache.admit(self, message, result):
+                    cache.put(key, result, text)
+            except (ApiError, OSError, asyncio.TimeoutError, websockets.WebSocketException, TypeError, ValueError):
+                # A result that can not be judged is not stored.
+                pass
+
+    async def _dispatch(self, message, keys):
+        if not keys:
+            return await self._fetch(message)
+        # Identical cacheable requests in flight at the same time share one server round trip.
+        flight = self._inflight.get(keys[0][1])
+        if flight is not None:
+            return copy.deepcopy(await asyncio.shield(flight))
+        flight = self._inflight[keys[0][1]] = asyncio.ensure_future(self._fill(message, keys))
+        flight.add_done_callback(_retrieve)
+        return await asyncio.shield(flight)
+
+    async def _resolve(self, message):
+        policy = self._policy()
+        if policy.raw:
+            return await self._fetch(message, raw=True)
+        keys, value = self._cached(message)
+        if value is _MISSING:
+            value = await self._dispatch(message, keys)
+        return self._typed(message, value) if policy.typed else value
+
+    async def _request_many(self, messages):
+        return list(await asyncio.gather(*(self._resolve(message) for message in messages), return_exceptions=True))
+
     def _make_request(self, message):
-        message['params']['timestamp'] = timestamp()
-        message['params']['signature'] = self._make_signature(message)
-        str_msg = json.dumps(message, separators=(',', ':'))
+        return self._run(self._send(message))
+
+    def _call(self, message):
+        policy = self._policy()
+        if policy.raw:
+            return self._run(self._fetch(message, raw=True))
+        keys, value = self._cached(message)
+        if value is _MISSING:
+            value = self._run(self._dispatch(message, keys))
+        return self._typed(message, value) if policy.typed else value
+
+    def _gather(self, messages):
+        return self._run(self._request_many(messages))
+
+    def _subscribe(self, subscription):
+        self.subscriptions.add(subscription)
+        try:
+            return self._run(subscription._start())
+        except BaseException:
+            self.subscriptions.discard(subscription)
+            raise
+
+    def batch(self):
+        """
+        Start a batch of calls that are signed and sent together.
+        Api methods called on the batch are queued and return the position of their result; execute() sends them
+        all at once and returns the results in call order.
+        :return: Returns a new Batch bound to this instance.
+        """
+        return Batch(self)
+
+    def pos_clock(self, chain_type='WAN', resync_interval=600.0):
+        """
+        Fetch the POS constants of a chain and return a clock computing epoch and slot ids locally.
+        :param chain_type: The chain of the clock. Currently supports 'WAN'.
+        :param resync_interval: Seconds after which the clock is compared with the server again.
+        :return: Returns a synchronized PosClock; with AsyncApiInstance it must be awaited.
+        """
+        return self._complete(PosClock(self, chain_type, resync_interval)._start())
+
+    def broadcast_pipeline(self, chain_type='WAN', window=32, retries=3, nonces=None):
+        """
+        Start a pipeline sending signed transactions concurrently while keeping each sender's nonces in order.
+        :param chain_type: The chain the transactions are sent to.
+        :param window: Maximum number of transactions of one sender in flight.
+        :param retries: Number of times a transaction rejected because of its nonce is signed and sent again.
+        :param nonces: NonceManager to number transactions with; by default a new one.
+        :return: Returns a BroadcastPipeline; queue transactions with submit().
+        """
+        return BroadcastPipeline(self, chain_type, window, retries, nonces)
+
+    def contract(self, sc_addr, abi, chain_type='WAN'):
+        """
+        Prepare a contract for repeated calls of call_sc_func, get_sc_map and get_sc_var.
+        :param sc_addr: Address of the contract.
+        :param abi: The abi of the contract.
+        :param chain_type: The chain of the contract. Currently supports "WAN" or "ETH".
+        :return: Returns a Contract; contract.function(name), contract.map(name) and contract.var(name) return
+        prepared callables.
+        """
+        return Contract(self, sc_addr, abi, chain_type)
+
+    def track_confirmations(self, wait_blocks=1, chain_type='WAN', poll_interval=1.0):
+        """
+        Start tracking transactions until they are confirmed, following the chain once for all of them.
+        :param wait_blocks: Number of blocks, counting the one holding a transaction, it must be buried under.
+        :param chain_type: The chain the transactions were sent to.
+        :param poll_interval: Seconds between polls of the chain head.
+        :return: Returns a ConfirmationTracker; add transactions to it with add() or add_many().
+        """
+        return ConfirmationTracker(self, wait_blocks, chain_type, poll_interval)
 
-        async def send():
-            async with websockets.connect(self.endpoint) as websocket:
-                await websocket.send(str_msg)
-                return await websocket.recv()
-        return asyncio.get_event_loop().run_until_complete(send())
+    def follow_blocks(self, from_block=None, chain_type='WAN', transactions=False, **options):
+        """
+        Follow the chain head, yielding new blocks in order and rollback events on reorganizations.
+        :param from_block: First block to yield; by default the latest block when following starts.
+        :param chain_type: The chain being followed. Currently supports "WAN" or "ETH".
+        :param transactions: Whether to fetch the transactions of each block as well.
+        :param options: Prefetch and polling options of BlockFollower.
+        :return: Returns a BlockFollower yielding BlockEvent tuples.
+        """
+        return BlockFollower(self, from_block, chain_type, transactions, **options)
 
     # Accounts methods #
     def get_balance(self, address, chain_type='WAN'):
@@ -56,8 +3028,7 @@ class ApiInstance:
         """
         message = self._new_message("getBalance", chain_type)
         message['params']['address'] = str(address)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_multi_balances(self, addresses, chain_type='WAN'):
         """
@@ -68,8 +3039,7 @@ class ApiInstance:
         """
         message = self._new_message("getMultiBalances", chain_type)
         message['params']['address'] = addresses
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_nonce(self, address, chain_type='WAN'):
         """
@@ -80,8 +3050,7 @@ class ApiInstance:
         """
         message = self._new_message("getNonce", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_nonce_include_pending(self, address, chain_type='WAN'):
         """
@@ -92,8 +3061,7 @@ class ApiInstance:
         """
         message = self._new_message("getNonceIncludePending", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_utxo(self, address, minconf, maxconf, chain_type='BTC'):
         """
@@ -108,8 +3076,7 @@ class ApiInstance:
         message['params']['address'] = address
         message['params']['minconf'] = minconf
         message['params']['maxconf'] = maxconf
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def import_address(self, address, chain_type='BTC'):
         """
@@ -120,8 +3087,7 @@ class ApiInstance:
         """
         message = self._new_message("importAddress", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     # Blocks #
     def get_block_by_hash(self, block_hash, chain_type='WAN'):
@@ -133,8 +3099,7 @@ class ApiInstance:
         """
         message = self._new_message("getBlockByHash", chain_type)
         message['params']['blockNumber'] = block_hash
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_block_by_number(self, block_number, chain_type='WAN'):
         """
@@ -145,8 +3110,7 @@ class ApiInstance:
         """
         message = self._new_message("getBlockByNumber", chain_type)
         message['params']['blockNumber'] = block_number
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_block_number(self, chain_type='WAN'):
         """
@@ -155,8 +3119,7 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getBlockNumber", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_block_transaction_count(self, block_number=None, block_hash=None, chain_type='WAN'):
         """
@@ -171,8 +3134,7 @@ class ApiInstance:
             message['params']['blockNumber'] = block_number
         if block_hash is not None:
             message['params']['blockHash '] = block_hash
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     # Contracts #
     def call_sc_func(self, sc_addr, name, args, abi, chain_type='WAN'):
@@ -190,8 +3152,7 @@ class ApiInstance:
         message['params']['name'] = name
         message['params']['args'] = args
         message['params']['abi'] = abi
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_sc_map(self, sc_addr, name, key, abi, chain_type='WAN'):
         """
@@ -208,8 +3169,7 @@ class ApiInstance:
         message['params']['name'] = name
         message['params']['key'] = key
         message['params']['abi'] = abi
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_sc_var(self, sc_addr, name, abi, chain_type='WAN'):
         """
@@ -224,8 +3184,7 @@ class ApiInstance:
         message['params']['scAddr'] = sc_addr
         message['params']['name'] = name
         message['params']['abi'] = abi
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     # CrossChain #
     def get_coin_2_wan_ratio(self, cross_chain='ETH'):
@@ -236,8 +3195,7 @@ class ApiInstance:
         """
         message = self._new_message("getCoin2WanRatio")
         message['params']['crossChain'] = cross_chain
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_reg_tokens(self, cross_chain='ETH'):
         """
@@ -247,8 +3205,7 @@ class ApiInstance:
         """
         message = self._new_message("getRegTokens")
         message['params']['crossChain'] = cross_chain
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_storeman_groups(self, cross_chain='ETH'):
         """
@@ -258,8 +3215,7 @@ class ApiInstance:
         """
         message = self._new_message("getStoremanGroups")
         message['params']['crossChain'] = cross_chain
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_token_2_wan_ratio(self, token_sc_address, cross_chain='ETH'):
         """
@@ -271,15 +3227,13 @@ class ApiInstance:
         message = self._new_message("getToken2WanRatio")
         message['params']['crossChain'] = cross_chain
         message['params']['tokenScAddr'] = token_sc_address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_token_storeman_groups(self, token_sc_address, cross_chain='ETH'):
         message = self._new_message("getTokenStoremanGroups")
         message['params']['crossChain'] = cross_chain
         message['params']['tokenScAddr'] = token_sc_address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     # Events #
     def get_sc_event(self, address, topics, from_block=None, to_block=None, chain_type='WAN'):
@@ -297,22 +3251,35 @@ class ApiInstance:
         message['params']['topics'] = topics
         message['params']['fromBlock'] = from_block
         message['params']['toBlock'] = to_block
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
+
+    def scan_sc_event(self, address, topics, from_block=0, to_block=None, chain_type='WAN', **options):
+        """
+        Get smart contract event logs over a large block range, fetched in adaptive chunks several at a time.
+        :param address:The contract address.
+        :param topics:An array of string values which must each appear in the log entries, as for get_sc_event.
+        :param from_block:The number of the earliest block. By default 0.
+        :param to_block:The number of the latest block. By default the latest block when the scan starts.
+        :param chain_type:The chain being queried. Currently supports 'WAN' and 'ETH'.
+        :param options:Chunking, concurrency and checkpoint options of LogScanner.
+        :return: Returns a LogScanner yielding the logs in block order.
+        """
+        return LogScanner(self, address, topics, from_block, to_block, chain_type, **options)
 
-    def monitor_event(self, address, topics, chain_type='WAN'):
+    def monitor_event(self, address, topics, chain_type='WAN', max_queue=1024, overflow='drop_oldest'):
         """
         Subscribe to a smart contract event monitor. The server will push the event to the subscriber when the event occurs.
         :param address:The contract address.
         :param topics:Array of values which must each appear in the log entries. The order is important, if you want to leave topics out use null, e.g. [null, '0x00...'].
         :param chain_type:The chain being queried. Currently supports 'WAN' and 'ETH'.
-        :return: Returns result object from api response.
+        :param max_queue:Maximum number of pushed events waiting to be consumed.
+        :param overflow:What to do when the queue is full: 'drop_oldest', 'drop_newest' or 'block', which gives the subscription a connection of its own.
+        :return: Returns a Subscription yielding the pushed events; its result attribute holds the api response to the subscription.
         """
         message = self._new_message("monitorEvent", chain_type)
         message['params']['address'] = address
         message['params']['topics'] = topics
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._subscribe(Subscription(self, message, max_queue, overflow))
 
     # POS #
     def get_activity(self, epoch_id, chain_type='WAN'):
@@ -324,8 +3291,7 @@ class ApiInstance:
         """
         message = self._new_message("getActivity", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_current_epoch_info(self, chain_type='WAN'):
         """
@@ -334,8 +3300,7 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getCurrentEpochInfo", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_current_staker_info(self, chain_type='WAN'):
         """
@@ -344,16 +3309,14 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getCurrentStakerInfo", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_delegator_incentive(self, address, from_epoch, to_epoch, chain_type='WAN'):
         message = self._new_message("getDelegatorIncentive", chain_type)
         message['params']['address'] = address
         message['params']['from'] = from_epoch
         message['params']['to'] = to_epoch
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_delegator_stake_info(self, address, chain_type='WAN'):
         """
@@ -364,8 +3327,7 @@ class ApiInstance:
         """
         message = self._new_message("getDelegatorStakeInfo", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_delegator_sup_stake_info(self, address, chain_type='WAN'):
         """
@@ -376,8 +3338,7 @@ class ApiInstance:
         """
         message = self._new_message("getDelegatorSupStakeInfo", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_delegator_total_incentive(self, address, validator_address=None, from_epoch=None, to_epoch=None,
                                       chain_type='WAN'):
@@ -398,13 +3359,11 @@ class ApiInstance:
             message['params']['from'] = from_epoch
         if to_epoch is not None:
             message['params']['to'] = to_epoch
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_epoch_id(self, chain_type='WAN'):
         message = self._new_message("getEpochID", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_epoch_id_by_time(self, query_time, chain_type='WAN'):
         """
@@ -415,8 +3374,7 @@ class ApiInstance:
         """
         message = self._new_message("getEpochIDByTime", chain_type)
         message['params']['time'] = query_time
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_epoch_incentive_block_number(self, epoch_id, chain_type='WAN'):
         """
@@ -427,8 +3385,7 @@ class ApiInstance:
         """
         message = self._new_message("getEpochIncentiveBlockNumber", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_epoch_incentive_pay_detail(self, epoch_id, chain_type='WAN'):
         """
@@ -439,8 +3396,7 @@ class ApiInstance:
         """
         message = self._new_message("getEpochIncentivePayDetail", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_epoch_leaders_by_epoch_id(self, epoch_id, chain_type='WAN'):
         """
@@ -451,8 +3407,7 @@ class ApiInstance:
         """
         message = self._new_message("getEpochLeadersByEpochID", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_epoch_stake_out(self, epoch_id, chain_type='WAN'):
         """
@@ -463,8 +3418,7 @@ class ApiInstance:
         """
         message = self._new_message("getEpochStakeOut", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_leader_group_by_epoch_id(self, epoch_id, chain_type='WAN'):
         """
@@ -475,8 +3429,7 @@ class ApiInstance:
         """
         message = self._new_message("getLeaderGroupByEpochID", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_max_block_number(self, epoch_id, chain_type='WAN'):
         """
@@ -487,8 +3440,7 @@ class ApiInstance:
         """
         message = self._new_message("ime", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_max_stable_blk_number(self, chain_type='WAN'):
         """
@@ -497,8 +3449,7 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getMaxStableBlkNumber", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_pos_info(self, chain_type='WAN'):
         """
@@ -507,8 +3458,7 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getPosInfo", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_random(self, epoch_id, block_number, chain_type='WAN'):
         """
@@ -521,8 +3471,7 @@ class ApiInstance:
         message = self._new_message("getRandom", chain_type)
         message['params']['epochID'] = epoch_id
         message['params']['blockNumber'] = block_number
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_random_proposers_by_epoch_id(self, epoch_id, chain_type='WAN'):
         """
@@ -533,8 +3482,7 @@ class ApiInstance:
         """
         message = self._new_message("getRandomProposersByEpochID", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_slot_activity(self, epoch_id, chain_type='WAN'):
         """
@@ -545,8 +3493,7 @@ class ApiInstance:
         """
         message = self._new_message("getSlotActivity", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_slot_count(self, chain_type='WAN'):
         """
@@ -555,8 +3502,7 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getSlotCount", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_slot_id(self, chain_type='WAN'):
         """
@@ -565,8 +3511,7 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getSlotID", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_slot_time(self, chain_type='WAN'):
         """
@@ -575,8 +3520,7 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getSlotTime", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_staker_info(self, block_number, chain_type='WAN'):
         """
@@ -587,8 +3531,7 @@ class ApiInstance:
         """
         message = self._new_message("getStakerInfo", chain_type)
         message['params']['blockNumber'] = block_number
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_time_by_epoch_id(self, epoch_id, chain_type='WAN'):
         """
@@ -599,8 +3542,7 @@ class ApiInstance:
         """
         message = self._new_message("getTimeByEpochID", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_validator_activity(self, epoch_id, chain_type='WAN'):
         """
@@ -611,8 +3553,7 @@ class ApiInstance:
         """
         message = self._new_message("getValidatorActivity", chain_type)
         message['params']['epochID'] = epoch_id
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_validator_info(self, address, chain_type='WAN'):
         """
@@ -623,8 +3564,7 @@ class ApiInstance:
         """
         message = self._new_message("getValidatorInfo", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_validator_stake_info(self, address, chain_type='WAN'):
         """
@@ -635,8 +3575,7 @@ class ApiInstance:
         """
         message = self._new_message("getValidatorStakeInfo", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_validator_sup_stake_info(self, address, chain_type='WAN'):
         """
@@ -647,8 +3586,7 @@ class ApiInstance:
         """
         message = self._new_message("getValidatorSupStakeInfo", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_validator_total_incentive(self, address, from_epoch=None, to_epoch=None, chain_type='WAN'):
         """
@@ -665,8 +3603,7 @@ class ApiInstance:
             message['params']['from'] = from_epoch
         if to_epoch is not None:
             message['params']['to'] = to_epoch
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     # Status #
     def get_gas_price(self, chain_type='WAN'):
@@ -676,8 +3613,7 @@ class ApiInstance:
         :return: Returns result object from api response.
         """
         message = self._new_message("getGasPrice", chain_type)
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     # Tokens #
     def get_multi_token_balance(self, address, token_sc_address, chain_type='WAN'):
@@ -691,8 +3627,7 @@ class ApiInstance:
         message = self._new_message("getMultiTokenBalance", chain_type)
         message['params']['address'] = address
         message['params']['tokenScAddr'] = token_sc_address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_multi_token_info(self, token_sc_address_array, chain_type='WAN'):
         """
@@ -703,8 +3638,7 @@ class ApiInstance:
         """
         message = self._new_message("getMultiTokenInfo", chain_type)
         message['params']['tokenScAddrArray'] = token_sc_address_array
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_token_allowance(self, token_sc_address, owner_address, spender_address, chain_type='WAN'):
         """
@@ -719,8 +3653,7 @@ class ApiInstance:
         message['params']['tokenScAddr'] = token_sc_address
         message['params']['ownerAddr'] = owner_address
         message['params']['spenderAddr'] = spender_address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_token_balance(self, address, token_sc_address, chain_type='WAN'):
         """
@@ -733,8 +3666,7 @@ class ApiInstance:
         message = self._new_message("getTokenBalance", chain_type)
         message['params']['address'] = address
         message['params']['tokenScAddr'] = token_sc_address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_token_info(self, token_sc_address, chain_type='WAN'):
         """
@@ -745,8 +3677,7 @@ class ApiInstance:
         """
         message = self._new_message("getTokenInfo", chain_type)
         message['params']['tokenScAddr'] = token_sc_address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_token_supply(self, token_sc_address, chain_type='WAN'):
         """
@@ -757,8 +3688,7 @@ class ApiInstance:
         """
         message = self._new_message("getTokenSupply", chain_type)
         message['params']['tokenScAddr'] = token_sc_address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     # Transactions #
     def get_trans_by_address(self, address, chain_type='WAN'):
@@ -770,8 +3700,7 @@ class ApiInstance:
         """
         message = self._new_message("getTransByAddress", chain_type)
         message['params']['address'] = address
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_trans_by_address_between_blocks(self, address, start_block_number, end_block_number, chain_type='WAN'):
         """
@@ -789,8 +3718,19 @@ class ApiInstance:
         message['params']['address'] = address
         message['params']['startBlockNo'] = start_block_number
         message['params']['endBlockNo'] = end_block_number
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
+
+    def iter_trans_by_address(self, address, from_block=0, to_block=None, chain_type='WAN', **options):
+        """
+        Iterate the transactions of an address block window by block window, without holding the whole history.
+        :param address:The account's address that you want to search.
+        :param from_block:The first block number to search. By default 0.
+        :param to_block:The last block number to search. By default the latest block when iteration starts.
+        :param chain_type:The chain being queried. Currently supports "WAN".
+        :param options:Window, prefetch and checkpoint options of AddressHistory.
+        :return: Returns an AddressHistory yielding the transactions in block order.
+        """
+        return AddressHistory(self, address, from_block, to_block, chain_type, **options)
 
     def get_trans_by_block(self, block_number=None, block_hash=None, chain_type='WAN'):
         """
@@ -805,8 +3745,7 @@ class ApiInstance:
             message['params']['blockNumber'] = block_number
         if block_hash is not None:
             message['params']['blockHash'] = block_hash
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_transaction_confirm(self, wait_blocks, tx_hash, chain_type='WAN'):
         """
@@ -819,8 +3758,7 @@ class ApiInstance:
         message = self._new_message("getTransactionConfirm", chain_type)
         message['params']['waitBlocks'] = wait_blocks
         message['params']['txHash'] = tx_hash
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_transaction_receipt(self, tx_hash, chain_type='WAN'):
         """
@@ -831,8 +3769,7 @@ class ApiInstance:
         """
         message = self._new_message("getTransactionReceipt", chain_type)
         message['params']['txHash'] = tx_hash
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def get_tx_info(self, tx_hash, out_format=None, chain_type='WAN'):
         """
@@ -846,8 +3783,7 @@ class ApiInstance:
         message['params']['txHash'] = tx_hash
         if out_format is not None:
             message['params']['format'] = out_format
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
 
     def send_raw_transaction(self, signed_tx, chain_type='WAN'):
         """
@@ -858,5 +3794,119 @@ class ApiInstance:
         """
         message = self._new_message("sendRawTransaction", chain_type)
         message['params']['signedTx'] = signed_tx
-        response = json.loads(self._make_request(message))
-        return response['result']
+        return self._call(message)
+
+
+class AsyncApiInstance(ApiInstance):
+    """
+    Asyncio client with the same methods as ApiInstance; every method returns an awaitable.
+    Concurrent calls share the pooled connection and are matched to their replies by JSON-RPC id.
+    Must be used from a running event loop.
+    """
+    def __init__(self, api_key, secret_key, uri='wss://api.wanchain.org:8443/ws/v3/', pool_size=1, **options):
+        super().__init__(api_key, secret_key, uri, pool_size, **options)
+
+    def __enter__(self):
+        raise TypeError("use 'async with' with AsyncApiInstance")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """
+        Close subscriptions and pooled connections. The instance can not be used afterwards.
+        """
+        self.closed = True
+        for subscription in list(self.subscriptions):
+            await subscription.aclose()
+        await (self.pool if self.router is None else self.router).close()
+
+    # Utility methods #
+    def _check_open(self, coroutine=None):
+        # A closed instance would otherwise quietly open new connections.
+        if self.closed:
+            if coroutine is not None:
+                coroutine.close()
+            raise RuntimeError("AsyncApiInstance is closed")
+
+    async def _make_request(self, message):
+        return await self._send(message)
+
+    async def _fetch(self, message, raw=False):
+        self._check_open()
+        return await super()._fetch(message, raw)
+
+    async def _call(self, message):
+        self._check_open()
+        return await self._resolve(message)
+
+    def _spawn(self, coroutine):
+        self._check_open(coroutine)
+        asyncio.ensure_future(coroutine)
+
+    def _future(self):
+        return asyncio.get_running_loop().create_future()
+
+    async def _complete(self, coroutine):
+        self._check_open(coroutine)
+        return await coroutine
+
+    async def _gather(self, messages):
+        self._check_open()
+        return await self._request_many(messages)
+
+    async def _subscribe(self, subscription):
+        self._check_open()
+        self.subscriptions.add(subscription)
+        try:
+            return await subscription._start()
+        except BaseException:
+            self.subscriptions.discard(subscription)
+            raise
+
+    def _run(self, coroutine):
+        coroutine.close()
+        raise TypeError("AsyncApiInstance can only be used with await")
+
+
+class Batch:
+    """
+    Queue of api calls sent together by execute().
+    Any ApiInstance method can be called on a batch, e.g. batch.get_gas_price() or batch.get_token_balance(...).
+    A failed call leaves its exception in place of its result, so the other results are not lost.
+    """
+    EXCLUDED = frozenset(['batch', 'close', 'monitor_event', 'scan_sc_event', 'iter_trans_by_address',
+                          'follow_blocks', 'pos_clock', 'track_confirmations', 'broadcast_pipeline',
+                          'contract'])
+
+    def __init__(self, api):
+        self._api = api
+        self._messages = []
+
+    def __getattr__(self, name):
+        method = getattr(type(self._api), name, None)
+        if name.startswith('_') or name in self.EXCLUDED or not callable(method):
+            raise AttributeError(name)
+        return functools.partial(method, self)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def _new_message(self, method, chain_type=None):
+        return self._api._new_message(method, chain_type)
+
+    def _call(self, message):
+        self._messages.append(message)
+        return len(self._messages) - 1
+
+    def execute(self):
+        """
+        Sign and send every queued call at once. The batch is emptied and can be reused.
+        :return: Returns a list with one result or exception per queued call, in call order. With AsyncApiInstance
+        the list must be awaited.
+        """
+        messages, self._messages = self._messages, []
+        return self._api._gather(messages)
@@ -0,0 +1,131 @@
+"""
+Shared fixtures: a MockServer running on its own event loop thread, so both ApiInstance and AsyncApiInstance can be
+tested against it. Run from the repository root: python -m pytest -q
+"""
+import asyncio
+import collections
+import json
+import os
+import sys
+import threading
+
+import pytest
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from mock_server import MockServer  # noqa: E402
+
+# Answer of a method that is never replied to.
+STALL = object()
+
+
+class Rejected(Exception):
+    """
+    Raised by an override to answer with an error response carrying the message.
+    """
+
+
+class Node(MockServer):
+    """
+    MockServer whose answers can be replaced per method. An override is a result, STALL, or a function of the params
+    returning either; a function may also raise Rejected. Received params are recorded per method.
+    """
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.overrides = {}
+        self.calls = collections.Counter()
+        self.params = collections.defaultdict(list)
+        self.uri = None
+        self.loop = None
+
+    def publish(self, result):
+        """
+        Push an event from the test thread; returns the number of subscriptions it was sent to.
+        """
+        return asyncio.run_coroutine_threadsafe(self.push(result), self.loop).result()
+
+    def drop_subscribers(self):
+        """
+        Close the connections subscriptions were made on, as a server restart would.
+        """
+        async def drop():
+            subscribers, self.subscribers = self.subscribers, []
+            await asyncio.gather(*(websocket.close() for websocket, _ in subscribers))
+
+        asyncio.run_coroutine_threadsafe(drop(), self.loop).result()
+
+    def result(self, method, params):
+        override = self.overrides.get(method, MockServer)
+        if override is MockServer:
+            return super().result(method, params)
+        return override(params) if callable(override) else override
+
+    async def _reply(self, websocket, frame):
+        message = json.loads(frame)
+        method = message['method']
+        self.calls[method] += 1
+        self.params[method].append(message['params'])
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not self.verify(message):
+            self.rejected += 1
+            response = {"jsonrpc": "2.0", "id": message['id'], "error": {"code": 401, "message": "bad signature"}}
+        else:
+            try:
+                result = self.result(method, message['params'])
+            except Rejected as exc:
+                result = exc
+            if result is STALL:
+                return
+            if isinstance(result, Rejected):
+                response = {"jsonrpc": "2.0", "id": message['id'], "error": {"code": -32000, "message": str(result)}}
+            else:
+                response = {"jsonrpc": "2.0", "id": message['id'], "result": result}
+                if method == "monitorEvent":
+                    self.subscribers.append((websocket, message['id']))
+        try:
+            await websocket.send(json.dumps(response, separators=(',', ':')))
+        except websockets.ConnectionClosed:
+            pass
+
+
+@pytest.fixture
+def serve():
+    """
+    Start Node instances on a background loop: serve(**options) returns a started Node with its uri set.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    servers = []
+
+    async def start(node):
+        server = await websockets.serve(node.handle, "127.0.0.1", 0, max_size=None)
+        node.uri = "ws://127.0.0.1:{}/".format(server.sockets[0].getsockname()[1])
+        servers.append(server)
+
+    def factory(**options):
+        node = Node(**options)
+        node.loop = loop
+        asyncio.run_coroutine_threadsafe(start(node), loop).result()
+        return node
+
+    yield factory
+
+    async def stop():
+        for server in servers:
+            server.close()
+        await asyncio.gather(*(server.wait_closed() for server in servers))
+
+    asyncio.run_coroutine_threadsafe(stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def node(serve):
+    return serve()
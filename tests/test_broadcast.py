@@ -0,0 +1,125 @@
+import asyncio
+import collections
+import threading
+
+import iwan
+from conftest import Rejected
+
+
+class Nonces:
+    """
+    Accounts of a Node: transactions are "sender:nonce" strings, accepted in any order within a window and mined in
+    nonce order.
+    """
+    def __init__(self, node):
+        self.next = collections.defaultdict(int)
+        self.queued = collections.defaultdict(set)
+        node.overrides["getNonceIncludePending"] = lambda params: hex(self.next[params['address']])
+        node.overrides["sendRawTransaction"] = self.send
+
+    def send(self, params):
+        sender, nonce = params['signedTx'].split(":")
+        nonce = int(nonce)
+        if nonce < self.next[sender] or nonce in self.queued[sender]:
+            raise Rejected("nonce too low")
+        if nonce > self.next[sender] + 64:
+            raise Rejected("nonce gap too large")
+        self.queued[sender].add(nonce)
+        self.promote(sender)
+        return "0x{}{:04d}".format(sender[2:], nonce)
+
+    def promote(self, sender):
+        while self.next[sender] in self.queued[sender]:
+            self.queued[sender].discard(self.next[sender])
+            self.next[sender] += 1
+
+    def take(self, sender, count):
+        # Another wallet of the same account sends transactions.
+        self.next[sender] += count
+        self.promote(sender)
+
+
+def _signer(sender):
+    return lambda nonce: "{}:{}".format(sender, nonce)
+
+
+def test_pipeline_numbers_each_sender_in_order(node):
+    accounts = Nonces(node)
+    accounts.next["0xbb"] = 40
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        pipeline = api.broadcast_pipeline(window=8)
+        futures = [pipeline.submit(sender, _signer(sender)) for _ in range(50) for sender in ("0xaa", "0xbb")]
+        hashes = [future.result(10) for future in futures]
+    assert hashes[:4] == ["0xaa0000", "0xbb0040", "0xaa0001", "0xbb0041"]
+    assert len(set(hashes)) == 100
+    assert pipeline.sent == 100 and pipeline.failed == 0
+    assert node.calls["getNonceIncludePending"] == 2
+
+
+def test_pipeline_recovers_from_taken_nonces(node):
+    accounts = Nonces(node)
+
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri, pool_size=4) as api:
+            pipeline = api.broadcast_pipeline(window=32)
+            futures = [pipeline.submit("0xaa", _signer("0xaa")) for _ in range(300)]
+            await asyncio.sleep(0.02)
+            accounts.take("0xaa", 5)
+            results = await asyncio.gather(*futures, return_exceptions=True)
+            return pipeline, results
+
+    pipeline, results = asyncio.run(run())
+    assert [result for result in results if isinstance(result, Exception)] == []
+    assert pipeline.nonces.resyncs <= 2
+    assert accounts.next["0xaa"] == 305 and not accounts.queued["0xaa"]
+
+
+def test_resync_from_threads(node):
+    Nonces(node)
+    errors = []
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        nonces = iwan.NonceManager(api)
+
+        def take():
+            for _ in range(200):
+                try:
+                    nonces.next_nonce("0xAA")
+                except Exception as exc:
+                    errors.append(exc)
+
+        def resync():
+            for _ in range(200):
+                nonces.resync("0xaa")
+
+        threads = [threading.Thread(target=target) for target in (take, take, resync, resync)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert errors == []
+    assert nonces.resyncs > 0
+
+
+def test_pipeline_survives_a_failing_signer(node):
+    accounts = Nonces(node)
+    signed = []
+
+    def sign(nonce):
+        signed.append(nonce)
+        if len(signed) == 2:
+            raise ValueError("signer failed")
+        return "0xaa:{}".format(nonce)
+
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        pipeline = api.broadcast_pipeline(window=8)
+        futures = [pipeline.submit("0xaa", sign) for _ in range(5)]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(10))
+            except ValueError as exc:
+                results.append(exc)
+    assert isinstance(results[1], ValueError)
+    assert [result for index, result in enumerate(results) if index != 1] == ["0xaa0000", "0xaa0001", "0xaa0002",
+                                                                              "0xaa0003"]
+    assert accounts.next["0xaa"] == 4 and not accounts.queued["0xaa"]
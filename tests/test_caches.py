@@ -0,0 +1,133 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import iwan
+from conftest import STALL, Rejected
+
+
+def _settle(seconds=0.1):
+    # Admission runs in the background after the result is returned.
+    time.sleep(seconds)
+
+
+def _reject(params):
+    raise Rejected("lookup failed")
+
+
+def test_pos_cache_stores_past_epochs(node):
+    node.overrides["getEpochID"] = 100
+    cache = iwan.PosHistoryCache()
+    with iwan.ApiInstance("key", "secret", uri=node.uri, pos_cache=cache) as api:
+        first = api.get_activity(5)
+        _settle()
+        assert api.get_activity(5) == first
+    assert node.calls["getActivity"] == 1
+    assert len(cache) == 1
+
+
+def test_pos_cache_keeps_current_epoch_out(node):
+    node.overrides["getEpochID"] = 5
+    cache = iwan.PosHistoryCache()
+    with iwan.ApiInstance("key", "secret", uri=node.uri, pos_cache=cache) as api:
+        api.get_activity(5)
+        _settle()
+        api.get_activity(5)
+    assert node.calls["getActivity"] == 2
+    assert len(cache) == 0
+
+
+def test_pos_cache_admission_failure_does_not_fail_the_call(node):
+    node.overrides["getEpochID"] = "not a number"
+    cache = iwan.PosHistoryCache()
+    with iwan.ApiInstance("key", "secret", uri=node.uri, pos_cache=cache) as api:
+        assert api.get_activity(5)
+        _settle()
+        node.overrides["getEpochID"] = _reject
+        assert api.get_activity(5)
+        _settle()
+    assert node.calls["getActivity"] == 2
+    assert len(cache) == 0
+
+
+def test_cold_call_does_not_wait_for_admission(node):
+    node.overrides["getEpochID"] = STALL
+    cache = iwan.PosHistoryCache()
+    with iwan.ApiInstance("key", "secret", uri=node.uri, pos_cache=cache,
+                          policy=iwan.CallPolicy(timeout=5.0)) as api:
+        started = time.monotonic()
+        assert api.get_activity(5)
+        assert time.monotonic() - started < 1
+
+
+def test_finality_cache_stores_stable_blocks(node):
+    cache = iwan.FinalityCache()
+    with iwan.ApiInstance("key", "secret", uri=node.uri, block_cache=cache) as api:
+        block = api.get_block_by_number(50)
+        _settle()
+        assert api.get_block_by_number(50) == block
+        api.get_block_by_number(node.block_number)
+        _settle()
+        api.get_block_by_number(node.block_number)
+    assert node.calls["getBlockByNumber"] == 3
+
+
+def test_finality_cache_lookup_timeout_does_not_fail_the_call(node):
+    node.overrides["getMaxStableBlkNumber"] = STALL
+    cache = iwan.FinalityCache(stable_refresh=0.0)
+    with iwan.ApiInstance("key", "secret", uri=node.uri, block_cache=cache,
+                          policy=iwan.CallPolicy(timeout=0.2)) as api:
+        started = time.monotonic()
+        assert api.get_block_by_number(50)['number'] == 50
+        assert time.monotonic() - started < 0.2
+        _settle(0.3)
+        node.overrides["getMaxStableBlkNumber"] = node.block_number
+        assert api.get_block_by_number(50)['number'] == 50
+        _settle()
+        assert api.get_block_by_number(50)['number'] == 50
+    assert node.calls["getBlockByNumber"] == 2
+    assert len(cache) == 1
+
+
+def test_cached_result_is_a_snapshot(node):
+    cache = iwan.FinalityCache()
+    with iwan.ApiInstance("key", "secret", uri=node.uri, block_cache=cache) as api:
+        block = api.get_block_by_number(50)
+        block['hash'] = "changed by the caller"
+        _settle()
+        assert api.get_block_by_number(50)['hash'] == "0x{:064x}".format(50)
+
+
+def test_ttl_cache_expires_values(node):
+    cache = iwan.TtlCache(ttls={"getBlockNumber": 0.2})
+    with iwan.ApiInstance("key", "secret", uri=node.uri, ttl_cache=cache) as api:
+        assert api.get_block_number() == node.block_number
+        node.overrides["getBlockNumber"] = node.block_number + 1
+        assert api.get_block_number() == node.block_number
+        time.sleep(0.3)
+        assert api.get_block_number() == node.block_number + 1
+    assert node.calls["getBlockNumber"] == 2
+    assert cache.hits == 1
+
+
+def test_ttl_cache_serves_stale_values_while_one_request_refreshes(serve):
+    node = serve(latency=0.1)
+    cache = iwan.TtlCache(ttls={"getBlockNumber": 0.05}, stale=5.0)
+    with iwan.ApiInstance("key", "secret", uri=node.uri, ttl_cache=cache) as api:
+        api.get_block_number()
+        time.sleep(0.1)
+        node.overrides["getBlockNumber"] = node.block_number + 1
+        started = time.monotonic()
+        assert [api.get_block_number() for _ in range(10)] == [node.block_number] * 10
+        assert time.monotonic() - started < 0.1
+        _settle(0.3)
+        assert api.get_block_number() == node.block_number + 1
+    assert node.calls["getBlockNumber"] == 2
+
+
+def test_ttl_cache_coalesces_concurrent_misses(serve):
+    node = serve(latency=0.1)
+    with iwan.ApiInstance("key", "secret", uri=node.uri, ttl_cache=iwan.TtlCache()) as api:
+        with ThreadPoolExecutor(10) as executor:
+            prices = list(executor.map(lambda _: api.get_gas_price(), range(10)))
+    assert prices == ["180000000000"] * 10
+    assert node.calls["getGasPrice"] == 1
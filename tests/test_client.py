@@ -0,0 +1,183 @@
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import iwan
+from conftest import Rejected
+
+ADDRESS = "0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"
+CODECS = [name for name in ("orjson", "ujson", "json") if name == "json" or getattr(iwan, name) is not None]
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("value", [1e-7, 1e16, 0.1, "é", " ", 2 ** 70, -2 ** 64, None])
+def test_signature_round_trip(node, codec, value):
+    with iwan.ApiInstance("key", "secret", uri=node.uri, codec=iwan.JsonCodec.named(codec)) as api:
+        api.get_utxo("address", value, 1)
+    assert node.rejected == 0
+    assert node.params["getUTXO"][0]['minconf'] == value
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("value", [2 ** 63, -2 ** 63 - 1, -9999999999999999999, 2 ** 70, 10 ** 30])
+def test_wide_integers_decode_exactly(codec, value):
+    loads = iwan.JsonCodec.named(codec).loads
+    assert loads(json.dumps({"result": [1, value]})) == {"result": [1, value]}
+    assert loads(json.dumps({"result": value}).encode()) == {"result": value}
+
+
+def test_threads_share_pool(node):
+    with iwan.ApiInstance("key", "secret", uri=node.uri, pool_size=4) as api, ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(lambda _: api.get_balance(ADDRESS), range(400)))
+        assert results == ["10000000000000000000"] * 400
+        assert api.pool.opened <= 4
+
+
+def test_closed_instance_raises(node):
+    api = iwan.ApiInstance("key", "secret", uri=node.uri)
+    with ThreadPoolExecutor(16) as executor:
+        assert len(list(executor.map(lambda _: api.get_balance(ADDRESS), range(100)))) == 100
+    api.close()
+    api.close()
+    with pytest.raises(RuntimeError, match="closed"):
+        api.get_balance(ADDRESS)
+    with pytest.raises(RuntimeError, match="closed"):
+        api.batch().execute()
+
+
+def test_close_unused_instance():
+    api = iwan.ApiInstance("key", "secret", uri="ws://127.0.0.1:9/")
+    api.close()
+    with pytest.raises(RuntimeError, match="closed"):
+        api.get_balance(ADDRESS)
+
+
+def test_closed_async_instance_raises(node):
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri) as api:
+            await api.get_balance(ADDRESS)
+        with pytest.raises(RuntimeError, match="closed"):
+            await api.get_balance(ADDRESS)
+        with pytest.raises(RuntimeError, match="closed"):
+            await api.batch().execute()
+        with pytest.raises(RuntimeError, match="closed"):
+            await api.monitor_event("0xabc", [])
+        with pytest.raises(RuntimeError, match="closed"):
+            await api.broadcast_pipeline().nonces.next_nonce(ADDRESS)
+        return api
+
+    api = asyncio.run(run())
+    assert api.pool.opened == 1
+    assert node.calls["getBalance"] == 1
+
+
+def test_slow_handshake_does_not_block_open_connections(serve):
+    node = serve(latency=0.1)
+
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri, pool_size=2) as api:
+            await api.get_balance(ADDRESS)
+            connect = api.pool._connect
+
+            async def slow_connect():
+                await asyncio.sleep(2)
+                return await connect()
+
+            api.pool._connect = slow_connect
+            started = time.monotonic()
+            # Both connections of the pool are busy, one of them still being opened.
+            first = asyncio.ensure_future(api.get_balance(ADDRESS))
+            await asyncio.sleep(0.01)
+            second = asyncio.ensure_future(api.get_balance(ADDRESS))
+            await asyncio.sleep(0.01)
+            await api.get_balance(ADDRESS)
+            assert time.monotonic() - started < 1
+            await asyncio.gather(first, second)
+            assert time.monotonic() - started < 1
+
+    asyncio.run(run())
+
+
+def test_idle_connections_are_pinged_once(node):
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri, pool_size=2) as api:
+            await api.get_balance(ADDRESS)
+            api.pool.ping_interval = 0.0
+            results = await asyncio.wait_for(asyncio.gather(*(api.get_balance(ADDRESS) for _ in range(10))), 5)
+            assert results == ["10000000000000000000"] * 10
+
+    asyncio.run(run())
+
+
+def test_requests_keep_order_while_pool_grows(node):
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri, pool_size=4) as api:
+            await asyncio.gather(*(api.send_raw_transaction("0x{:04x}".format(i)) for i in range(50)))
+
+    asyncio.run(run())
+    sent = [params['signedTx'] for params in node.params["sendRawTransaction"]]
+    assert sent == ["0x{:04x}".format(i) for i in range(50)]
+
+
+def test_prepared_contract(node):
+    abi = [{"name": "fn{}".format(i), "type": "function", "inputs": [], "outputs": []} for i in range(20)]
+    abi.append({"name": "balanceOf", "type": "function", "inputs": [{"name": "who", "type": "address"}],
+                "outputs": [{"name": "", "type": "uint256"}]})
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        contract = api.contract("0xabc", json.dumps(abi))
+        balance_of = contract.function("balanceOf")
+        assert contract.function("balanceOf") is balance_of
+        assert balance_of(ADDRESS) == "10000000000000000000"
+        assert balance_of.many([[ADDRESS]] * 3) == ["10000000000000000000"] * 3
+        with pytest.raises(ValueError):
+            contract.var("missing")
+    assert node.rejected == 0
+    params = node.params["callScFunc"][0]
+    assert params['abi'] == abi[-1:]
+    assert params['args'] == [ADDRESS]
+    assert params['scAddr'] == "0xabc" and params['name'] == "balanceOf"
+
+
+def test_large_replies_are_accepted(serve):
+    node = serve(items=2500)
+    with iwan.ApiInstance("key", "secret", uri=node.uri, pool_size=1) as api:
+        with ThreadPoolExecutor(6) as executor:
+            stakers = executor.submit(api.get_current_staker_info)
+            balances = [executor.submit(api.get_balance, ADDRESS) for _ in range(5)]
+            assert len(json.dumps(stakers.result())) > 2 ** 20
+            assert [balance.result() for balance in balances] == ["10000000000000000000"] * 5
+    assert node.calls["getCurrentStakerInfo"] == 1 and node.calls["getBalance"] == 5
+
+
+def test_batch_keeps_failures_in_place(node):
+    def reject(params):
+        raise Rejected("no such token")
+
+    node.overrides["getTokenBalance"] = reject
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        batch = api.batch()
+        assert batch.get_block_number() == 0
+        batch.get_token_balance(ADDRESS, "0xabc")
+        batch.get_gas_price()
+        assert len(batch) == 3
+        block_number, token_balance, gas_price = batch.execute()
+        assert len(batch) == 0 and batch.execute() == []
+        with pytest.raises(AttributeError):
+            batch.monitor_event
+    assert block_number == node.block_number
+    assert isinstance(token_balance, iwan.ApiError) and str(token_balance) == "no such token"
+    assert gas_price == "180000000000"
+
+
+def test_async_batch(node):
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri) as api:
+            batch = api.batch()
+            for number in range(3):
+                batch.get_block_by_number(number)
+            return await batch.execute()
+
+    assert [block['number'] for block in asyncio.run(run())] == [0, 1, 2]
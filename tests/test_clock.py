@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+import pytest
+
+import iwan
+
+
+class Slots:
+    """
+    POS clock of a Node: 5 second slots, 17280 to an epoch, running offset slots ahead of the local clock.
+    """
+    def __init__(self, node, offset=0):
+        self.offset = offset
+        node.overrides["getSlotTime"] = 5
+        node.overrides["getSlotCount"] = 17280
+        node.overrides["getEpochID"] = lambda params: self.index() // 17280
+        node.overrides["getSlotID"] = lambda params: self.index() % 17280
+
+    def index(self):
+        return int(time.time() // 5) + self.offset
+
+
+def test_clock_matches_the_server(node):
+    slots = Slots(node, offset=3)
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        clock = api.pos_clock()
+        requests = sum(node.calls.values())
+        for _ in range(100):
+            assert clock.epoch_id() * 17280 + clock.slot_id() in (slots.index(), slots.index() - 1)
+        assert sum(node.calls.values()) == requests
+    assert clock.offset == 3 and clock.drifts == 0
+    assert node.calls["getSlotTime"] == 1 and node.calls["getPosInfo"] == 1
+
+
+def test_epoch_start_times(node):
+    Slots(node, offset=-17280 * 2)
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        clock = api.pos_clock()
+    epoch_id = clock.epoch_id()
+    start = clock.time_by_epoch_id(epoch_id)
+    assert clock.epoch_id_by_time(start) == epoch_id and clock.slot_id(start) == 0
+    assert clock.epoch_id_by_time(start - 1) == epoch_id - 1
+    assert clock.time_by_epoch_id(epoch_id + 1) - start == 17280 * 5
+
+
+def test_clock_resyncs_in_the_background(node):
+    slots = Slots(node)
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        clock = api.pos_clock(resync_interval=0.05)
+        slots.offset = 7
+        time.sleep(0.1)
+        clock.slot_id()
+        time.sleep(0.1)
+        assert clock.offset == 7 and clock.drifts == 1
+    epoch_id = node.calls["getEpochID"]
+    # A clock of a closed instance keeps working without resyncing.
+    time.sleep(0.1)
+    clock.slot_id()
+    assert node.calls["getEpochID"] == epoch_id
+
+
+def test_async_clock(node):
+    slots = Slots(node, offset=1)
+
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri) as api:
+            return await api.pos_clock()
+
+    clock = asyncio.run(run())
+    assert clock.offset == 1 and clock.slot_id() in (slots.index() % 17280, (slots.index() - 1) % 17280)
+
+
+def test_invalid_slot_time_raises(node):
+    node.overrides["getSlotTime"] = 0
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        with pytest.raises(ValueError):
+            api.pos_clock()
@@ -0,0 +1,86 @@
+import asyncio
+
+import iwan
+from conftest import Rejected
+
+ADDRESSES = ["0x{:040x}".format(number) for number in range(1, 21)]
+
+
+def _gathered(node, calls, return_exceptions=False, **options):
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri, coalescer=iwan.Coalescer(**options)) as api:
+            results = await asyncio.gather(*(call(api) for call in calls), return_exceptions=return_exceptions)
+            return results, api.coalescer
+
+    return asyncio.run(run())
+
+
+def test_concurrent_balances_share_one_request(node):
+    results, coalescer = _gathered(node, [lambda api, address=address: api.get_balance(address)
+                                          for address in ADDRESSES])
+    assert results == ["10000000000000000000"] * 20
+    assert node.calls["getMultiBalances"] == 1 and node.calls["getBalance"] == 0
+    assert node.params["getMultiBalances"][0]['address'] == ADDRESSES
+    assert coalescer.requests == 1 and coalescer.items == 20
+
+
+def test_balances_are_matched_regardless_of_case(node):
+    node.overrides["getMultiBalances"] = lambda params: {address.lower(): address.lower()[-4:]
+                                                         for address in params['address']}
+    addresses = ["0x" + "AbCd" * 9 + "{:04X}".format(number) for number in range(0xFFF0, 0xFFF4)]
+    results, _ = _gathered(node, [lambda api, address=address: api.get_balance(address) for address in addresses])
+    assert results == ["fff0", "fff1", "fff2", "fff3"]
+    assert node.calls["getMultiBalances"] == 1 and node.calls["getBalance"] == 0
+
+
+def test_lone_and_missing_balances_are_sent_on_their_own(node):
+    results, _ = _gathered(node, [lambda api: api.get_balance(ADDRESSES[0])])
+    assert results == ["10000000000000000000"]
+    assert node.calls["getMultiBalances"] == 0 and node.calls["getBalance"] == 1
+    node.overrides["getMultiBalances"] = lambda params: {params['address'][0]: "1"}
+    results, _ = _gathered(node, [lambda api, address=address: api.get_balance(address) for address in ADDRESSES[:2]])
+    assert results == ["1", "10000000000000000000"]
+    assert node.calls["getMultiBalances"] == 1 and node.calls["getBalance"] == 2
+
+
+def test_batches_are_flushed_at_max_batch(node):
+    results, coalescer = _gathered(node, [lambda api, address=address: api.get_balance(address)
+                                          for address in ADDRESSES], max_batch=8, window=1.0)
+    assert len(results) == 20
+    assert [len(params['address']) for params in node.params["getMultiBalances"]] == [8, 8, 4]
+    assert coalescer.requests == 3
+
+
+def test_balances_on_different_chains_are_not_merged(node):
+    _gathered(node, [lambda api, address=address, chain=chain: api.get_balance(address, chain)
+                     for address in ADDRESSES[:4] for chain in ("WAN", "ETH")])
+    assert sorted(params['chainType'] for params in node.params["getMultiBalances"]) == ["ETH", "WAN"]
+
+
+def test_token_balances_are_grouped_by_token(node):
+    calls = [lambda api, address=address, token=token: api.get_token_balance(address, token)
+             for address in ADDRESSES[:5] for token in ("0xaaa", "0xbbb")]
+    results, coalescer = _gathered(node, calls)
+    assert results == ["5000000000000000000"] * 10
+    assert node.calls["getTokenBalance"] == 0
+    batches = sorted((params['tokenScAddr'], len(params['address'])) for params in node.params["getMultiTokenBalance"])
+    assert batches == [("0xaaa", 5), ("0xbbb", 5)]
+    assert coalescer.requests == 2
+
+
+def test_token_infos_share_one_request(node):
+    tokens = ["0x{:040x}".format(number) for number in range(1, 6)]
+    results, _ = _gathered(node, [lambda api, token=token: api.get_token_info(token) for token in tokens + tokens[:1]])
+    assert results == [{"symbol": "TKN", "decimals": "18"}] * 6
+    assert node.calls["getMultiTokenInfo"] == 1 and node.calls["getTokenInfo"] == 0
+    assert node.params["getMultiTokenInfo"][0]['tokenScAddrArray'] == tokens
+
+
+def test_failed_multi_request_fails_every_caller(node):
+    def reject(params):
+        raise Rejected("too many tokens")
+
+    node.overrides["getMultiTokenInfo"] = reject
+    results, _ = _gathered(node, [lambda api, token=token: api.get_token_info(token) for token in ("0xa", "0xb")],
+                           return_exceptions=True)
+    assert [str(result) for result in results] == ["too many tokens"] * 2
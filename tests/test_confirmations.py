@@ -0,0 +1,115 @@
+import concurrent.futures
+import time
+
+import pytest
+
+import iwan
+
+
+class Ledger:
+    """
+    Chain of a Node whose blocks hold given transactions; the hash of each block names the fork it is on.
+    """
+    def __init__(self, node, head=100):
+        self.head = head
+        self.forks = {}
+        self.transactions = {}
+        node.overrides["getBlockNumber"] = lambda params: self.head
+        node.overrides["getMaxStableBlkNumber"] = lambda params: self.head - 20
+        node.overrides["getBlockByNumber"] = self.block
+        node.overrides["getTransactionReceipt"] = self.receipt
+
+    def hash(self, number):
+        return "0x{:062x}{:02x}".format(number, self.forks.get(number, 0))
+
+    def block(self, params):
+        number = params['blockNumber']
+        if number > self.head:
+            return None
+        return {"number": number, "hash": self.hash(number), "parentHash": self.hash(number - 1),
+                "transactions": self.transactions.get(number, [])}
+
+    def receipt(self, params):
+        for number, hashes in self.transactions.items():
+            if number <= self.head and params['txHash'] in hashes:
+                return {"transactionHash": params['txHash'], "blockNumber": number, "status": "0x1"}
+        return None
+
+    def mine(self, hashes=()):
+        self.head += 1
+        self.transactions[self.head] = list(hashes)
+
+    def replace(self, number):
+        # The block is replaced by an empty one on another fork.
+        self.forks[number] = self.forks.get(number, 0) + 1
+        self.transactions[number] = []
+
+
+def _hashes(count):
+    return ["0x{:064x}".format(0xabcdef000 + index) for index in range(count)]
+
+
+def _settle():
+    time.sleep(0.15)
+
+
+def test_tracker_confirms_many_transactions(node):
+    ledger = Ledger(node)
+    hashes = _hashes(50)
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        tracker = api.track_confirmations(wait_blocks=3, poll_interval=0.01)
+        futures = tracker.add_many(hashes)
+        _settle()
+        ledger.mine(hashes[:25])
+        ledger.mine(hashes[25:])
+        _settle()
+        assert not any(future.done() for future in futures)
+        ledger.mine()
+        _settle()
+        assert [future.done() for future in futures] == [True] * 25 + [False] * 25
+        ledger.mine()
+        receipts = [future.result(5) for future in futures]
+        _settle()
+        assert len(tracker) == 0
+    assert [receipt['blockNumber'] for receipt in receipts] == [101] * 25 + [102] * 25
+    # One receipt when a transaction is added and one when it reaches its depth.
+    assert node.calls["getTransactionReceipt"] == 100
+
+
+def test_tracker_waits_again_after_a_rollback(node):
+    ledger = Ledger(node)
+    tx_hash = _hashes(1)[0]
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        tracker = api.track_confirmations(wait_blocks=3, poll_interval=0.01)
+        future = tracker.add(tx_hash)
+        _settle()
+        ledger.mine([tx_hash])
+        _settle()
+        ledger.replace(101)
+        ledger.mine()
+        _settle()
+        ledger.mine([tx_hash])
+        ledger.mine()
+        _settle()
+        assert not future.done()
+        ledger.mine()
+        assert future.result(5)['blockNumber'] == 103
+
+
+def test_tracker_callbacks_and_cancel(node):
+    ledger = Ledger(node)
+    mined, pending = _hashes(2)
+    ledger.mine([mined])
+    ledger.mine()
+    confirmed = []
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        tracker = api.track_confirmations(wait_blocks=2, poll_interval=0.01)
+        # Hashes are matched regardless of case.
+        assert tracker.add(mined.upper(), callback=lambda *args: confirmed.append(args)).result(5)
+        waiting = tracker.add(pending, wait_blocks=10)
+        _settle()
+        tracker.cancel()
+        with pytest.raises(concurrent.futures.CancelledError):
+            waiting.result(5)
+        assert len(tracker) == 0
+    assert confirmed == [(mined.upper(), {"transactionHash": mined, "blockNumber": 101, "status": "0x1"})]
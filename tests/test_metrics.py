@@ -0,0 +1,79 @@
+import re
+
+import iwan
+from conftest import Rejected
+
+ADDRESS = "0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"
+
+
+def _reject(params):
+    raise Rejected("unknown address")
+
+
+def test_summary_counts_calls_errors_and_connections(node):
+    metrics = iwan.Metrics()
+    node.overrides["getNonce"] = _reject
+    with iwan.ApiInstance("secretkey", "secret", uri=node.uri, metrics=metrics) as api:
+        for _ in range(3):
+            api.get_balance(ADDRESS)
+        try:
+            api.get_nonce(ADDRESS)
+        except iwan.ApiError:
+            pass
+    summary = metrics.summary()
+    assert summary["getBalance"]["calls"] == 3 and summary["getBalance"]["errors"] == 0
+    assert 0 < summary["getBalance"]["latency_p50"] <= summary["getBalance"]["latency_p99"]
+    assert summary["getBalance"]["request_size_mean"] > 100 and summary["getBalance"]["response_size_mean"] > 20
+    assert summary["getNonce"]["errors"] == 1
+    assert summary["connections"] == {node.uri: {"opened": 1, "reused": 3}}
+
+
+def test_prometheus_output(node):
+    metrics = iwan.Metrics()
+    with iwan.ApiInstance("secretkey", "secret", uri=node.uri, metrics=metrics) as api:
+        for _ in range(4):
+            api.get_balance(ADDRESS)
+    metrics.on_error('get"Odd', 1, 0.1, ValueError())
+    text = metrics.prometheus()
+    assert "secretkey" not in text
+    assert text.count("# TYPE iwan_request_duration_seconds histogram\n") == 1
+    buckets = [int(count) for count in re.findall(
+        r'^iwan_request_duration_seconds_bucket\{method="getBalance",le="[^"]+"\} (\d+)$', text, re.MULTILINE)]
+    assert len(buckets) == len(iwan.Metrics.LATENCY_BUCKETS) + 1
+    assert buckets == sorted(buckets) and buckets[-1] == 4
+    assert 'iwan_request_duration_seconds_count{method="getBalance"} 4\n' in text
+    assert 'iwan_errors_total{method="get\\"Odd",kind="ValueError"} 1\n' in text
+    assert 'iwan_connections_opened_total{{endpoint="{}"}} 1\n'.format(node.uri) in text
+
+
+def test_histogram_quantiles():
+    histogram = iwan._Histogram((1.0, 2.0, 4.0))
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 3.0):
+        histogram.observe(value)
+    assert histogram.quantile(0.25) == 1.0
+    assert histogram.quantile(0.5) == 1.5
+    assert histogram.quantile(1.0) == 4.0
+    histogram.observe(10.0)
+    assert histogram.quantile(1.0) == 4.0
+
+
+def test_hooks_can_trace_calls(node):
+    class Tracer(iwan.Metrics):
+        def __init__(self):
+            super().__init__()
+            self.spans = []
+
+        def on_request(self, method, request_id, size, sign_time):
+            super().on_request(method, request_id, size, sign_time)
+            self.spans.append(("start", method, request_id))
+
+        def on_response(self, method, request_id, latency, size, parse_time):
+            super().on_response(method, request_id, latency, size, parse_time)
+            self.spans.append(("end", method, request_id))
+
+    tracer = Tracer()
+    with iwan.ApiInstance("key", "secret", uri=node.uri, metrics=tracer) as api:
+        api.get_block_number()
+    (start, method, first), (end, _, second) = tracer.spans
+    assert (start, end, method) == ("start", "end", "getBlockNumber") and first == second
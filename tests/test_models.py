@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import iwan
+
+ADDRESS = "0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"
+
+
+def test_typed_results_decode_fields(node):
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        with api.options(typed=True):
+            block = api.get_block_by_number(50)
+            transactions = api.get_trans_by_block(50)
+            receipt = api.get_transaction_receipt("0x" + "5a" * 32)
+            balance = api.get_balance(ADDRESS)
+        untyped = api.get_block_by_number(50)
+    assert isinstance(block, iwan.Block) and isinstance(untyped, dict)
+    assert block.number == 50 and block.parent_hash == "0x{:064x}".format(49)
+    assert block.difficulty == 1 and block['logsBloom'] == "0x" + "0" * 512
+    assert [transaction.value for transaction in transactions] == [10 ** 18] * node.items
+    assert transactions[0].gas_price == 10 ** 10 and transactions[0].from_ == ADDRESS
+    assert receipt.status == 1 and isinstance(receipt.logs[0], iwan.Log)
+    assert receipt.logs[0].block_number == node.block_number
+    assert balance == "10000000000000000000"
+
+
+def test_fields_are_decoded_once_on_first_read():
+    payload = json.dumps({"number": "0x10", "hash": "0xab", "transactions": [{"nonce": "0x2"}, "0xcd"]}).encode()
+    block = iwan.Block(payload)
+    assert block._values is None
+    assert block.number == 16
+    assert block._decoded == 1 << iwan.Block.number.index
+    transactions = block.transactions
+    assert block.transactions is transactions
+    assert transactions[0].nonce == 2 and transactions[1] == "0xcd"
+    assert block.timestamp is None and block.get('missing', 0) == 0
+    with pytest.raises(KeyError):
+        block['missing']
+
+
+def test_models_compare_by_content():
+    first = iwan.Transaction({"hash": "0x01", "value": "0x10"})
+    second = iwan.Transaction(json.dumps({"hash": "0x01", "value": "0x10"}))
+    assert first == second and first != iwan.Log({"hash": "0x01", "value": "0x10"})
+    assert first.as_dict() == second.as_dict() == {"hash": "0x01", "value": "0x10"}
+    assert repr(first) == "Transaction(hash='0x01')"
+    with pytest.raises(TypeError):
+        hash(first)
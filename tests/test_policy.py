@@ -0,0 +1,164 @@
+import asyncio
+import time
+
+import pytest
+import websockets
+
+import iwan
+from conftest import STALL
+
+ADDRESS = "0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c"
+
+
+def test_attempt_timeouts_count_as_failures(node):
+    node.overrides["getBalance"] = STALL
+    limiter = iwan.RateLimiter(rate=None, concurrency=8, cooldown=0.0)
+    metrics = iwan.Metrics()
+    policy = iwan.CallPolicy(attempt_timeout=0.05, retries=2, backoff=0.0)
+    with iwan.ApiInstance("key", "secret", uri=node.uri, rate_limiter=limiter, metrics=metrics, policy=policy) as api:
+        with pytest.raises(asyncio.TimeoutError):
+            api.get_balance(ADDRESS)
+        assert api.retried == 2
+    assert node.calls["getBalance"] == 3
+    assert limiter.limit < 8
+    assert limiter.in_flight == 0
+    assert metrics.errors[("getBalance", "TimeoutError")] == 3
+
+
+def test_call_deadline_covers_retries(node):
+    node.overrides["getBalance"] = STALL
+    with iwan.ApiInstance("key", "secret", uri=node.uri, policy=iwan.CallPolicy(timeout=0.2, retries=5)) as api:
+        with pytest.raises(asyncio.TimeoutError):
+            api.get_balance(ADDRESS)
+        with api.options(timeout=None, attempt_timeout=0.05, retries=1, backoff=0.0):
+            with pytest.raises(asyncio.TimeoutError):
+                api.get_balance(ADDRESS)
+    assert node.calls["getBalance"] == 3
+
+
+def test_router_ejects_a_stalled_primary(serve):
+    primary, secondary = serve(), serve()
+    primary.overrides["sendRawTransaction"] = STALL
+    policy = iwan.CallPolicy(attempt_timeout=0.05)
+    with iwan.ApiInstance("key", "secret", uri=[primary.uri, secondary.uri], policy=policy) as api:
+        failures = 0
+        for _ in range(api.router.max_failures):
+            with pytest.raises(asyncio.TimeoutError):
+                api.send_raw_transaction("0x00")
+            failures += 1
+        assert api.send_raw_transaction("0x00") == "0x" + "5a" * 32
+        stats = api.router.stats()
+    assert primary.calls["sendRawTransaction"] == failures
+    assert secondary.calls["sendRawTransaction"] == 1
+    assert stats[primary.uri + "key"]["ejected"] > 0
+
+
+def test_writes_are_never_retried_or_hedged(node):
+    node.overrides["sendRawTransaction"] = STALL
+    policy = iwan.CallPolicy(attempt_timeout=0.05, retries=3, hedge={"sendRawTransaction", "getBalance"},
+                             hedge_min_samples=0)
+    assert policy.hedge == {"getBalance"}
+    assert policy.replace(hedge=iwan.CallPolicy.NON_IDEMPOTENT).hedge == frozenset()
+    with iwan.ApiInstance("key", "secret", uri=node.uri, policy=policy) as api:
+        with pytest.raises(asyncio.TimeoutError):
+            api.send_raw_transaction("0x00")
+    assert node.calls["sendRawTransaction"] == 1
+
+
+def test_hedged_reads_use_the_first_reply(node):
+    stalled = []
+
+    def stall_once(params):
+        if stalled:
+            return "10000000000000000000"
+        stalled.append(params)
+        return STALL
+
+    policy = iwan.CallPolicy(hedge=iwan.CallPolicy.LATENCY_CRITICAL, hedge_min_samples=5, hedge_percentile=0.5)
+    with iwan.ApiInstance("key", "secret", uri=node.uri, policy=policy) as api:
+        for _ in range(5):
+            api.get_balance(ADDRESS)
+        node.overrides["getBalance"] = stall_once
+        assert api.get_balance(ADDRESS) == "10000000000000000000"
+        assert api.hedged == 1
+    assert node.calls["getBalance"] == 7
+
+
+def test_oversized_replies_are_not_retried(serve):
+    node = serve(items=2500)
+    policy = iwan.CallPolicy(retries=3, backoff=0.0)
+    with iwan.ApiInstance("key", "secret", uri=node.uri, policy=policy, max_message_size=2 ** 20) as api:
+        with pytest.raises(websockets.ConnectionClosed):
+            api.get_current_staker_info()
+        assert api.retried == 0
+    assert node.calls["getCurrentStakerInfo"] == 1
+
+
+def test_limiter_halves_on_failure_and_ramps_up_on_success():
+    limiter = iwan.RateLimiter(rate=None, concurrency=8, min_concurrency=2, cooldown=10.0)
+
+    async def run():
+        for ok in (False, False, None):
+            await limiter.acquire()
+            limiter.release(ok)
+        # A second failure within the cooldown and a cancelled request leave the limit alone.
+        assert limiter.limit == 4
+        for _ in range(8):
+            await limiter.acquire()
+            limiter.release(True)
+
+    asyncio.run(run())
+    assert 5 < limiter.limit < 6
+    assert limiter.throttled == 2 and limiter.in_flight == 0
+
+
+def test_limiter_caps_requests_in_flight(serve):
+    node = serve(latency=0.05)
+    limiter = iwan.RateLimiter(rate=None, concurrency=2, max_concurrency=2)
+
+    async def run():
+        async with iwan.AsyncApiInstance("key", "secret", uri=node.uri, pool_size=4, rate_limiter=limiter) as api:
+            waiting = asyncio.gather(*(api.get_balance(ADDRESS) for _ in range(10)))
+            await asyncio.sleep(0.02)
+            stats = limiter.stats()
+            await waiting
+            return stats
+
+    started = time.monotonic()
+    stats = asyncio.run(run())
+    assert time.monotonic() - started >= 0.25
+    assert stats['in_flight'] == 2 and stats['waiting_for_concurrency'] == 8
+    assert limiter.in_flight == 0 and limiter.waiting_for_concurrency == 0
+
+
+def test_limiter_caps_the_request_rate(node):
+    limiter = iwan.RateLimiter(rate=20.0, burst=1)
+    with iwan.ApiInstance("key", "secret", uri=node.uri, rate_limiter=limiter) as api:
+        started = time.monotonic()
+        for _ in range(6):
+            api.get_balance(ADDRESS)
+        assert time.monotonic() - started >= 0.24
+    assert limiter.waiting_for_rate == 0
+
+
+def test_cancelled_waiter_passes_its_slot_on():
+    limiter = iwan.RateLimiter(rate=None, concurrency=1, max_concurrency=1)
+
+    async def run():
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release(None)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        await asyncio.wait_for(limiter.acquire(), 1.0)
+
+    asyncio.run(run())
+    assert limiter.in_flight == 1
+
+
+def test_limiter_is_shared_per_key():
+    limiter = iwan.RateLimiter.for_key("shared key", rate=5.0)
+    assert iwan.RateLimiter.for_key("shared key") is limiter
+    assert iwan.RateLimiter.for_key("other key") is not limiter
+    assert limiter.rate == 5.0
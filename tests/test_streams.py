@@ -0,0 +1,165 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+import iwan
+from conftest import Rejected
+
+
+class Chain:
+    """
+    Blocks served by a Node: the hash of each block names the fork it is on.
+    """
+    def __init__(self, node, head, stable):
+        self.head = head
+        self.stable = stable
+        self.forks = {}
+        node.overrides["getBlockNumber"] = lambda params: self.head
+        node.overrides["getMaxStableBlkNumber"] = lambda params: self.stable
+        node.overrides["getBlockByNumber"] = self.block
+
+    def hash(self, number):
+        return "0x{:062x}{:02x}".format(number, self.forks.get(number, 0))
+
+    def block(self, params):
+        number = params['blockNumber']
+        if number > self.head:
+            return None
+        return {"number": number, "hash": self.hash(number), "parentHash": self.hash(number - 1)}
+
+
+def _events(follower, count):
+    return [(event.kind, event.number, event.hash) for event in itertools.islice(follower, count)]
+
+
+def test_follower_rolls_back_replaced_blocks(node):
+    chain = Chain(node, head=12, stable=5)
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        follower = api.follow_blocks(from_block=10, poll_interval=0.01)
+        assert _events(follower, 3) == [("block", number, chain.hash(number)) for number in (10, 11, 12)]
+        replaced = chain.hash(12)
+        chain.forks.update({12: 1, 13: 1})
+        chain.head = 13
+        assert _events(follower, 3) == [("rollback", 12, replaced), ("block", 12, chain.hash(12)),
+                                        ("block", 13, chain.hash(13))]
+        assert follower.rollbacks == 1
+
+
+def test_follower_never_rolls_back_stable_blocks(node):
+    chain = Chain(node, head=12, stable=11)
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        follower = api.follow_blocks(from_block=10, poll_interval=0.05)
+        assert len(_events(follower, 3)) == 3
+        replaced = chain.hash(12)
+        # A lagging node serves a chain that disagrees with a stable block for a while.
+        chain.forks.update({11: 1, 12: 1, 13: 1})
+        chain.head = 13
+        assert _events(follower, 1) == [("rollback", 12, replaced)]
+        healed = threading.Timer(0.3, chain.forks.pop, (11,))
+        healed.start()
+        fetched = node.calls["getBlockByNumber"]
+        assert _events(follower, 2) == [("block", 12, chain.hash(12)), ("block", 13, chain.hash(13))]
+        healed.join()
+    # The conflicting block is fetched again once per poll, not in a busy loop.
+    assert node.calls["getBlockByNumber"] - fetched < 30
+
+
+def _logs(params):
+    first, last = params['fromBlock'], params['toBlock']
+    if last - first + 1 > 100:
+        raise Rejected("query returned more than 10000 results")
+    return [{"blockNumber": number, "logIndex": 0, "transactionHash": "0x{:064x}".format(number)}
+            for number in range(first, last + 1)]
+
+
+def test_scanner_splits_rejected_chunks(node):
+    node.overrides["getScEvent"] = _logs
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        scanner = api.scan_sc_event("0xabc", [], from_block=0, to_block=999, chunk_size=400, workers=3)
+        logs = list(scanner)
+    assert [log['blockNumber'] for log in logs] == list(range(1000))
+    assert scanner.splits > 0
+    assert scanner.next_block == 1000
+
+
+def test_scanner_raises_other_rejections_at_once(node):
+    def invalid(params):
+        raise Rejected("invalid address")
+
+    node.overrides["getScEvent"] = invalid
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        scanner = api.scan_sc_event("0xabc", [], from_block=0, to_block=999, chunk_size=100, workers=3)
+        with pytest.raises(iwan.ApiError, match="invalid address"):
+            list(scanner)
+    assert scanner.splits == 0
+    assert node.calls["getScEvent"] <= 3
+
+
+def test_scanner_resumes_from_checkpoint(node, tmp_path):
+    node.overrides["getScEvent"] = _logs
+    path = str(tmp_path / "scan.json")
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        scanner = api.scan_sc_event("0xabc", [], from_block=0, to_block=499, chunk_size=50, workers=1,
+                                    checkpoint=path)
+        first = [log['blockNumber'] for log in itertools.islice(scanner, 120)]
+        resumed = api.scan_sc_event("0xabc", [], from_block=0, to_block=499, chunk_size=50, checkpoint=path)
+        rest = [log['blockNumber'] for log in resumed]
+    assert first == list(range(120))
+    assert rest[0] <= 100 and rest[-1] == 499
+    assert sorted(set(first) | set(rest)) == list(range(500))
+
+
+def test_scanner_raises_below_min_chunk(node):
+    node.overrides["getScEvent"] = _logs
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        scanner = api.scan_sc_event("0xabc", [], from_block=0, to_block=999, chunk_size=400, min_chunk=200)
+        with pytest.raises(iwan.ApiError):
+            list(scanner)
+
+
+def _published(node, count, subscribers=1):
+    # Pushes go out only once the subscription reply has been sent.
+    for number in range(count):
+        while node.publish({"n": number}) < subscribers:
+            time.sleep(0.01)
+
+
+@pytest.mark.parametrize("pool_size", [1, 4])
+def test_full_subscription_does_not_hold_up_requests(node, pool_size):
+    with iwan.ApiInstance("key", "secret", uri=node.uri, pool_size=pool_size,
+                          policy=iwan.CallPolicy(timeout=1.0)) as api:
+        subscription = api.monitor_event("0xabc", [], max_queue=2)
+        _published(node, 10)
+        assert api.get_balance("0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c") == "10000000000000000000"
+        assert [event['n'] for event in itertools.islice(subscription, 2)] == [8, 9]
+        assert subscription.dropped == 8
+        subscription.close()
+        assert list(subscription) == []
+
+
+def test_blocking_subscription_has_its_own_connection(node):
+    with iwan.ApiInstance("key", "secret", uri=node.uri, pool_size=1, policy=iwan.CallPolicy(timeout=1.0)) as api:
+        subscription = api.monitor_event("0xabc", [], max_queue=1, overflow='block')
+        _published(node, 10)
+        assert api.get_balance("0x2cc79fa3b80c5b9b02051facd02478ea88a78e2c") == "10000000000000000000"
+        assert [event['n'] for event in itertools.islice(subscription, 10)] == list(range(10))
+        assert subscription.dropped == 0
+        _published(node, 5)
+        # Closing while the reader waits for room ends the stream at once.
+        subscription.close()
+        assert list(subscription) == []
+        assert api.pool.opened == 1
+
+
+def test_subscription_is_renewed_after_a_drop(node):
+    with iwan.ApiInstance("key", "secret", uri=node.uri) as api:
+        subscription = api.monitor_event("0xabc", [])
+        _published(node, 1)
+        assert next(subscription) == {"n": 0}
+        node.drop_subscribers()
+        _published(node, 1)
+        assert next(subscription) == {"n": 0}
+        assert subscription.renewed == 1
+    assert node.calls["monitorEvent"] == 2